@@ -7,60 +7,22 @@ import sys
 from platform import system
 from pathlib import Path
 
+from demoknight.analysis import batch_metrics, kept_passes, parse_percentages
+from demoknight.frametimes import load_results
+
 
 def main(argv):
     with open(Path(argv[0]).absolute(), encoding="utf-8") as outfile:
         file = json.loads(outfile.read())
         summary = []
-        # Import mangohud/presentmon summary and set some constants
-        if file["system"]["OS"].startswith("Win"):
-            usecols = (9, 7)
-            skiprows = 1
-            elapsed_second = 1
-            frametime_ms = 1
-        elif file["system"]["OS"].startswith("Linux"):
-            usecols = (1, 13)
-            skiprows = 3
-            elapsed_second = 1000000
-            frametime_ms = 1
+        percentages = parse_percentages(argv[1:])
+        # Mangohud/presentmon data of every pass, without the start buffer
+        captures = load_results(file)
         for test in file["tests"]:
-            entry = {
-                "name": test["name"],
-                "Average Frametime": [],
-                "Variance of Frametime": [],
-            }
-            for n in argv[1:]:
-                try:
-                    prcnt = float(n)
-                except:
-                    raise ValueError(
-                        "Percentages must be floats, with '.' as decimal separator"
-                    )
-                if prcnt <= 0:
-                    raise ValueError("Percentages must be positive integers")
-                entry[f"{n}% High of Frametime"] = []
-            for i, res in enumerate(test["results"]):
-                if i == 0 and not file["discard_passes"]:
-                    continue
-                arr = np.loadtxt(res, delimiter=",", usecols=usecols, skiprows=skiprows)
-                # We actually start capturing 2 seconds before we need to, so get
-                # rid of those rows
-                arr[:, 1] -= file["start_buffer"] * elapsed_second
-                arr = arr[arr[..., 1] >= 0]
-                entry["Average Frametime"].append(
-                    np.average(arr[:, 0] / frametime_ms, axis=0)
-                )
-                entry["Variance of Frametime"].append(
-                    np.var(arr[:, 0] / frametime_ms, axis=0)
-                )
-                for n in argv[1:]:
-                    if n:
-                        entry[f"{n}% High of Frametime"].append(
-                            np.percentile(
-                                arr[:, 0] / frametime_ms, 100 - float(n), axis=0
-                            )
-                        )
-
+            frametimes = [captures[test["name"]][i][0] for i in kept_passes(file, test)]
+            entry = {"name": test["name"]}
+            for k, v in batch_metrics(frametimes, percentages).items():
+                entry[k] = v.tolist()
             summary.append(entry)
         # Plotting each graph separately
         for key in summary[0].keys():
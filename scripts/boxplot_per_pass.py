@@ -8,56 +8,29 @@ import sys
 from platform import system
 from pathlib import Path
 
+from demoknight.analysis import batch_metrics, parse_percentages, pass_positions
+from demoknight.frametimes import load_results
+
 
 def main(argv):
     with open(Path(argv[0]).absolute(), encoding="utf-8") as outfile:
         file = json.loads(outfile.read())
         summary = []
-        # Import mangohud/presentmon data and set some constants
-        if file["system"]["OS"].startswith("Win"):
-            usecols = (9, 7)
-            skiprows = 1
-            elapsed_second = 1
-            frametime_ms = 1
-        elif file["system"]["OS"].startswith("Linux"):
-            usecols = (1, 13)
-            skiprows = 3
-            elapsed_second = 1000000
-            frametime_ms = 1
-        summary = [
-            defaultdict(list, {"name": f"Pass {n+1}"}) for n in range(file["passes"])
-        ]
+        # Mangohud/presentmon data of every pass, without the start buffer
+        captures = load_results(file)
+        # Passes grouped by their position in the loop, anchors left out
+        positions = {t["name"]: pass_positions(file, t) for t in file["tests"]}
+        count = max(
+            (p + 1 for pos in positions.values() for p in pos.values()), default=0
+        )
+        summary = [defaultdict(list, {"name": f"Pass {n+1}"}) for n in range(count)]
+        percentages = parse_percentages(argv[1:])
         for test in file["tests"]:
-            for n in argv[1:]:
-                try:
-                    prcnt = float(n)
-                except:
-                    raise ValueError(
-                        "Percentages must be floats, with '.' as decimal separator"
-                    )
-                if prcnt <= 0:
-                    raise ValueError("Percentages must be positive integers")
-            for i, res in enumerate(test["results"]):
-                arr = np.loadtxt(res, delimiter=",", usecols=usecols, skiprows=skiprows)
-                # We actually start capturing 2 seconds before we need to, so get
-                # rid of those rows
-                arr[:, 1] -= file["start_buffer"] * elapsed_second
-                arr = arr[arr[..., 1] >= 0]
-                summary[i % file["passes"]][
-                    f"{test['name']} - Average Frametime"
-                ].append(np.average(arr[:, 0] / frametime_ms, axis=0))
-                summary[i % file["passes"]][
-                    f"{test['name']} - Variance of Frametime"
-                ].append(np.var(arr[:, 0] / frametime_ms, axis=0))
-                for n in argv[1:]:
-                    if n:
-                        summary[i % file["passes"]][
-                            f"{test['name']} - {n}% High of Frametime"
-                        ].append(
-                            np.percentile(
-                                arr[:, 0] / frametime_ms, 100 - float(n), axis=0
-                            )
-                        )
+            position = positions[test["name"]]
+            frametimes = [captures[test["name"]][i][0] for i in position]
+            for k, values in batch_metrics(frametimes, percentages).items():
+                for i, v in zip(position, values):
+                    summary[position[i]][f"{test['name']} - {k}"].append(v)
 
         for k, v in summary[0].items():
             if isinstance(v, list):
@@ -7,6 +7,9 @@ import sys
 from platform import system
 from pathlib import Path
 
+from demoknight.analysis import timeline
+from demoknight.frametimes import load_results
+
 
 def main(argv):
     with open(Path(argv[0]).absolute(), encoding="utf-8") as outfile:
@@ -14,33 +17,12 @@ def main(argv):
     if not argv:
         print("Averages")
 
-    if file["system"]["OS"].startswith("Win"):
-        usecols = (9, 7)
-        skiprows = 1
-        one_second = 1
-    elif file["system"]["OS"].startswith("Linux"):
-        usecols = (1, 13)
-        skiprows = 3
-        one_second = 1000000000
+    captures = load_results(file)
     _, s = pl.subplots(figsize=(200, 10))
     for p in file["tests"]:
-        one_test = [[0, 0]]
-        for f in p["results"]:
-            arr = np.loadtxt(Path(f), delimiter=",", usecols=usecols, skiprows=skiprows)
-            arr[:, 1] -= 2 * one_second
-            arr = arr[arr[..., 1] >= 0]
-            arr[:, 1] = arr[:, 1] / one_second
-            one_test = np.concatenate((one_test, arr))
-        one_test[:, 1] = np.floor(one_test[:, 1] * 500) / 500
-        unique_values = np.unique(one_test[:, 1])
-        result = np.array(
-            [
-                [np.mean(one_test[one_test[:, 1] == value, 0]), value]
-                for value in unique_values
-            ]
-        )
-        result = result[result[:, 1].argsort()]
-        s.plot(result[:, 1], result[:, 0], linewidth=0.3, label=p["name"])
+        # Mean frametime every 2 ms, over every pass of the test
+        result = timeline(captures[p["name"]], 1 / 500, file["start_buffer"])
+        s.plot(result["time"], result["mean"], linewidth=0.3, label=p["name"])
     # pl.legend([plt[0] for plt in s], [p.name for p in list(P
     # ath(argv[0]).glob("./*"))])
     pl.xlabel("Time (s)")
@@ -0,0 +1,47 @@
+from matplotlib import pyplot as pl
+import numpy as np
+import json
+import sys
+from pathlib import Path
+
+from demoknight.analysis import timeline
+from demoknight.frametimes import load_results
+
+
+def main(argv):
+    with open(Path(argv[0]).absolute(), encoding="utf-8") as outfile:
+        file = json.loads(outfile.read())
+    if not file.get("workload_index"):
+        print("No workload index in this output file, was the demo found?")
+        return
+    index = np.load(file["workload_index"])
+    tick_interval = file["tick_interval"]
+    start = file["start_tick"]
+    end = start + file["duration"] / tick_interval
+    index = index[(index["tick"] >= start) & (index["tick"] < end)]
+
+    captures = load_results(file)
+    _, s = pl.subplots(figsize=(20, 10))
+    for p in file["tests"]:
+        # Mean frametime on every demo tick, to line up with the index
+        result = timeline(captures[p["name"]], tick_interval, file["start_buffer"])
+        s.plot(result["time"], result["mean"], linewidth=0.3, label=p["name"])
+    s.set_xlabel("Time (s)")
+    s.set_ylabel("Frametime (ms)")
+    s.legend(loc="upper left")
+
+    w = s.twinx()
+    seconds = (index["tick"] - start) * tick_interval
+    for field in ("entities", "sounds", "tempents", "usermessages"):
+        w.plot(seconds, index[field], linewidth=0.3, alpha=0.6, label=field)
+    w.set_ylabel("Events per tick")
+    w.legend(loc="upper right")
+
+    pl.tight_layout()
+    pl.savefig(f"{Path(argv[0]).name}_workload.svg", dpi=140, format="svg")
+
+    pl.show()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
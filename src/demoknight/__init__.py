@@ -3,11 +3,14 @@ import json
 import logging
 import os
 import re
+import struct
 import sys
+from collections import Counter
 from datetime import datetime
 from pathlib import Path
 from platform import system, platform, processor
 from tempfile import gettempdir
+from time import sleep
 
 import numpy as np
 from . import vdf_patch
@@ -17,6 +20,16 @@ from psutil import NoSuchProcess
 from steamid import SteamID
 import GPUtil
 
+from .demo import (
+    densest_window,
+    find_demo_file,
+    load_header,
+    workload_index,
+    workload_index_path,
+)
+from .journal import Journal
+from .schedule import Scheduler, drift_report
+from .session import Session
 from .test import Test
 
 if system().startswith("Win"):
@@ -28,9 +41,48 @@ if system().startswith("Win"):
     import win32security
 
 
+# Options kept in the summary that define the job, for --resume
+RESUMED_OPTIONS = (
+    "gameid",
+    "game_path",
+    "steam_path",
+    "tick_interval",
+    "comment",
+    "raw_path",
+    "demo_path",
+    "presentmon_path",
+    "launch_options",
+    "passes",
+    "loops",
+    "discard_passes",
+    "start_tick",
+    "start_buffer",
+    "duration",
+    "output_file",
+    "no_baseline",
+    "target_ci",
+    "min_passes",
+    "max_passes",
+    "stop_confidence",
+    "order",
+    "anchor_every",
+    "seed",
+    "reuse_game",
+    "ready_confidence",
+    "crash_budget",
+    "max_frametime",
+)
+
+
 def main():
     argv = sys.argv[1:]
 
+    # Modes to spread a job over several machines, with options of their own
+    if argv and argv[0] in ("coordinator", "agent"):
+        from . import distributed
+
+        return getattr(distributed, argv[0])(argv[1:])
+
     file_parser = argparse.ArgumentParser(
         allow_abbrev=False, prefix_chars="-", add_help=False
     )
@@ -48,6 +100,16 @@ def main():
         metavar="PATH",
     )
 
+    file_parser.add_argument(
+        "--resume",
+        help=(
+            "Path to the summary or journal (.jsonl) of an interrupted job to continue."
+            " Its options and tests are used again, and only the passes it is missing"
+            " are run. Options passed as command line options overwrite the job's"
+        ),
+        metavar="PATH",
+    )
+
     file_parser.add_argument(
         "-v",
         "--verbosity",
@@ -66,6 +128,10 @@ def main():
 
     logging.basicConfig(level=numeric_loglevel)
 
+    resumed = None
+    if args.job_file and args.resume:
+        raise ValueError("--job-file and --resume can't be used together")
+
     if args.job_file:
         file_dict = try_parsing_file(args.job_file)
 
@@ -80,6 +146,21 @@ def main():
                 rest_argv.insert(0, f"--{k}={str(v)}")
 
         argv_and_parsed = argv + list(file_dict.keys())
+    elif args.resume:
+        resumed = Journal.load(args.resume)
+        # Passes done are restored once the tests are set up
+        args.tests = [
+            {
+                k: v
+                for k, v in t.items()
+                if k not in ("results", "pass_info", "stop_reason")
+            }
+            for t in resumed["tests"]
+        ]
+        options = resume_options(resumed)
+        for k, v in options.items():
+            rest_argv.insert(0, f"--{k}={v}")
+        argv_and_parsed = argv + list(options.keys())
     else:
         argv_and_parsed = argv
 
@@ -210,6 +291,39 @@ def main():
                         " --tickrate or --tick_interval will be required"
                     )
 
+    # Read the header of the demo if it can be found, so the tick interval doesn't
+    # have to be guessed and the benchmark section can be checked before launching
+    demo_parser = argparse.ArgumentParser(
+        allow_abbrev=False, prefix_chars="-", add_help=False
+    )
+    demo_parser.add_argument("-D", "--demo-path")
+    demo_path = demo_parser.parse_known_args(args=rest_argv)[0].demo_path
+    header_game_path = args.game_path or next(
+        (
+            Path(t["game-path"])
+            for t in getattr(args, "tests", None) or []
+            if t.get("game-path")
+        ),
+        None,
+    )
+    demo_header = None
+    if demo_path and header_game_path:
+        demo_file = find_demo_file(header_game_path, demo_path)
+        if demo_file:
+            try:
+                demo_header = load_header(demo_file)
+            except ValueError as e:
+                logging.warning(e)
+        else:
+            logging.warning(f"Could not find {demo_path} to read its header")
+    if demo_header and demo_header.tick_interval:
+        default_tick_interval = demo_header.tick_interval
+        tick_interval_required = False
+        logging.info(
+            f"Tick interval read from the header of {demo_file}:"
+            f" {default_tick_interval}"
+        )
+
     parser = argparse.ArgumentParser(
         allow_abbrev=False, prefix_chars="-", parents=[game_parser]
     )
@@ -380,6 +494,116 @@ def main():
         ),
     )
 
+    parser.add_argument(
+        "--target-ci",
+        default=0,
+        type=float,
+        help=(
+            "Instead of running a fixed number of passes, stop a test once the"
+            " confidence interval of its mean frametime is narrower than this"
+            " fraction of the mean, or once it is clearly different from or the same"
+            " as the baseline within this fraction. 0 to always run --passes passes."
+            " Default: %(default)s"
+        ),
+    )
+
+    parser.add_argument(
+        "--min-passes",
+        default=3,
+        type=int,
+        help="Passes to run before --target-ci can stop a test. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--max-passes",
+        default=20,
+        type=int,
+        help="Most passes a test runs with --target-ci. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--stop-confidence",
+        default=0.95,
+        type=float,
+        help="Confidence level of the --target-ci decisions. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--order",
+        default="sequential",
+        choices=Scheduler.orders,
+        help=(
+            "Order of the passes in each loop. 'sequential' runs every pass of a test"
+            " before the next one, 'interleaved' takes turns between tests that don't"
+            " need a different launch (ABAB), 'random' shuffles every round of turns."
+            " Default: %(default)s"
+        ),
+    )
+
+    parser.add_argument(
+        "--anchor-every",
+        default=0,
+        type=int,
+        help=(
+            "Run an extra baseline pass after this many passes of other tests, to"
+            " measure and adjust for drift during the loop. 0 to disable. Default:"
+            " %(default)s"
+        ),
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for --order random. Default: random",
+    )
+
+    parser.add_argument(
+        "--reuse-game",
+        default=False,
+        action=StoreTrueFalseAction,
+        nargs="?",
+        const=True,
+        help=(
+            "Keep the game running between consecutive tests with the same launch"
+            " options, game-path and paths, resetting the cvars changed by each test"
+            " instead of restarting. Default: %(default)s"
+        ),
+    )
+
+    parser.add_argument(
+        "--ready-confidence",
+        default=0.95,
+        type=float,
+        help=(
+            "Confidence with which rcon latency, CPU and disk usage and console"
+            " output must have settled down after launching before the game is"
+            " considered ready. Default: %(default)s"
+        ),
+    )
+
+    parser.add_argument(
+        "--crash-budget",
+        default=3,
+        type=int,
+        help=(
+            "Times a test's passes can crash the game or fail to capture before the"
+            " test is given up on. Failed passes are retried after relaunching the"
+            " game, waiting longer after every failure. Default: %(default)s"
+        ),
+    )
+
+    parser.add_argument(
+        "--max-frametime",
+        default=1000,
+        type=float,
+        help=(
+            "Frametime in ms over which a pass is taken to have hit a hang or a load"
+            " and is captured again. Passes broken this way too many times in a row"
+            " count against --crash-budget. 0 to keep every pass, hitches included."
+            " Default: %(default)s"
+        ),
+    )
+
     parser.add_argument(
         "tests",
         action=SplitArgs,
@@ -395,6 +619,42 @@ def main():
     # Overwrite config file with command line options
     parser.parse_args(args=rest_argv, namespace=args)
 
+    if isinstance(args.tick_interval, list):
+        args.tick_interval = args.tick_interval[0]
+
+    if not 0.5 < args.ready_confidence < 1:
+        raise ValueError("--ready-confidence must be between 0.5 and 1")
+    if not 0.5 < args.stop_confidence < 1:
+        raise ValueError("--stop-confidence must be between 0.5 and 1")
+    if args.target_ci and not 1 <= args.min_passes <= args.max_passes:
+        raise ValueError("--min-passes must be at least 1 and at most --max-passes")
+
+    # Make sure the benchmark section fits in the demo before spending time on it
+    if demo_header:
+        args.demo_header = demo_header._asdict()
+        end_tick = args.start_tick + args.duration / args.tick_interval
+        # Headers of demos whose recording was cut short are never finalized, and
+        # have no length to check against
+        if demo_header.ticks and end_tick > demo_header.ticks:
+            raise ValueError(
+                f"--start-tick and --duration end the benchmark at tick {end_tick:.0f},"
+                f" but {demo_path} is only {demo_header.ticks} ticks long"
+            )
+
+        # Index what happens on every tick of the demo, so frametimes can be matched
+        # with demo content and the most demanding section can be found
+        try:
+            index = workload_index(demo_file)
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning(f"Could not index the workload of {demo_file}: {e}")
+        else:
+            args.workload_index = str(workload_index_path(demo_file))
+            densest = densest_window(index, round(args.duration / args.tick_interval))
+            logging.info(
+                f"Most entity updates for a {args.duration}s benchmark start at tick"
+                f" {densest}"
+            )
+
     # Presentmon group required
     if system().startswith("Win"):
         check_local_group()
@@ -404,39 +664,14 @@ def main():
         raise ValueError("Invalid log level: %s" % args.verbosity)
 
     # Include a job at the top of the list for baseline if required
-    if not args.no_baseline:
+    # A resumed job already has its baseline
+    if not args.no_baseline and not resumed:
         if not args.tests:
             args.tests = []
         args.tests.insert(0, {"name": "baseline", "changes": {}})
 
-    # Check for duplicate tests and generate test names and changes if empty
-    names = [n["name"] for n in args.tests if n.get("name") is not None]
-    if len(names) != len(set(names)):
-        raise ValueError("Multiple tests with the same name")
-
+    name_tests(args.tests)
     for t in args.tests:
-        if t.get("changes"):
-            if not t.get("name"):
-                concat_changes = " ".join(
-                    [
-                        " ".join([i for i in x if i is not None])
-                        for x in t["changes"].values()
-                    ]
-                )
-                if concat_changes == " ":
-                    concat_changes = "baseline"
-
-                timeout = 0
-                while timeout < 50:
-                    if concat_changes in names:
-                        concat_changes = f"{concat_changes}_{timeout}"
-                    else:
-                        names.append(concat_changes)
-                        t["name"] = concat_changes
-                        break
-                    timeout = +1
-        else:
-            t["changes"] = {}
         if t.get("game-path"):
             t["game-path"] = Path(t["game-path"])
 
@@ -475,8 +710,8 @@ def main():
     if eta > 3600:
         logging.warning(
             f"This job may take more than {str(round((eta/60/60), 2))} hours to"
-            " complete. Consider breaking it up into multiple jobs to avoid having to"
-            " redo due to crashes or other problems"
+            " complete. Consider breaking it up into multiple jobs, and use --resume"
+            " to continue it if it gets interrupted"
         )
 
     tests = []
@@ -484,63 +719,162 @@ def main():
         tests.append(Test(args, i))
 
     args.system = {"CPU": get_cpu_name(), "GPU": get_gpu_name(), "OS": platform()}
-    loops = 0
-    while args.loops == 0 or loops != args.loops:
+    # Passes the resumed job already has, by test, loop and whether they were anchors
+    done = Counter()
+    if resumed:
+        previous = {t["name"]: t for t in resumed["tests"]}
         for test in tests:
-            success = False
-            while not success:
-                print(f"Starting test {test.name}")
-                try:
-                    test.capture(args)
-                except NoSuchProcess:
-                    logging.error(
-                        "The game seems to have crashed, retrying entire test"
-                    )
-                    # TODO: If we later allow the tests to run continuously, we need to
-                    # handle the clearing of results better
-                    for path in (
-                        args.tests[test.index].get("changes", {}).get("paths", [])
-                    ):
-                        path = Test._check_paths(path)
-                    del test.results[-test.curr_pass :]
-                    continue
-                except KeyboardInterrupt:
+            entry = previous.get(test.name, {})
+            results = entry.get("results", [])
+            # Summaries from before pass_info only had a fixed number of passes
+            infos = entry.get("pass_info") or [
+                {"loop": i // args.passes, "anchor": False} for i in range(len(results))
+            ]
+            for result, info in zip(results, infos):
+                if not Path(result).exists():
                     logging.warning(
-                        "KeyboardInterrupt received. Some tests will probably end up with more passes than others."
+                        f"{result} is missing, its pass of {test.name} will run again"
                     )
-                    for path in (
-                        args.tests[test.index].get("changes", {}).get("paths", [])
-                    ):
-                        path = Test._check_paths(path)
-                    exit(0)
-                except FileNotFoundError as e:
-                    logging.error(e)
-                    for path in (
-                        args.tests[test.index].get("changes", {}).get("paths", [])
-                    ):
-                        path = Test._check_paths(path)
-                    del test.results[-test.curr_pass :]
                     continue
-                except FileNotFoundError as e:
-                    logging.error(e)
-                    for path in (
-                        args.tests[test.index].get("changes", {}).get("paths", [])
-                    ):
-                        path = Test._check_paths(path)
-                    del test.results[-test.curr_pass :]
-                    exit(0)
+                test.results.append(Path(result))
+                test.pass_info.append(info)
+                done[(test, info.get("loop", 0), info.get("anchor", False))] += 1
+        logging.info(f"Resuming {args.resume} with {sum(done.values())} passes done")
+
+    session = Session(args)
+    scheduler = Scheduler(args, tests)
+    summary_path = f"{args.output_file.absolute()}.json"
+    # A resumed job keeps its journal, a new job record starts over from it
+    journal = Journal(f"{args.output_file.absolute()}.jsonl", append=bool(resumed))
+    journal.job(args.__dict__)
+    for test in tests:
+        for result, info in zip(test.results, test.pass_info):
+            journal.add_pass(test.name, result, info)
+        args.tests[test.index]["results"] = test.results
+        args.tests[test.index]["pass_info"] = test.pass_info
+    # Failed passes per test, and seconds to wait before retrying after the first
+    crashes = Counter()
+    crash_backoff = 10
+    loops = 0
+    while args.loops == 0 or loops != args.loops:
+        for unit in scheduler.units(loops):
+            remaining = []
+            for test, anchor in unit:
+                if done[(test, loops, anchor)]:
+                    done[(test, loops, anchor)] -= 1
+                else:
+                    remaining.append((test, anchor))
+            if not remaining:
+                continue
+            unit = remaining
+            unit_tests = list({id(test): test for test, _ in unit}.values())
+            print(f"Starting {', '.join(test.name for test in unit_tests)}")
+            journal.event("unit", loop=loops, tests=[t.name for t in unit_tests])
+            # Passes that made it are kept, after a crash the unit carries on from
+            # the one that failed
+            position = 0
+            try:
+                while position < len(unit):
+                    test, anchor = unit[position]
+                    if test in scheduler.failed:
+                        position += 1
+                        continue
+                    try:
+                        test.run_pass(args, session, loop=loops, anchor=anchor)
+                    except (
+                        NoSuchProcess,
+                        FileNotFoundError,
+                        TimeoutError,
+                        RuntimeError,
+                    ) as e:
+                        if isinstance(e, NoSuchProcess):
+                            logging.error(
+                                f"The game seems to have crashed during a pass of"
+                                f" {test.name}"
+                            )
+                        else:
+                            logging.error(e)
+                        journal.event(
+                            (
+                                "crash"
+                                if isinstance(e, NoSuchProcess)
+                                else (
+                                    "broken"
+                                    if isinstance(e, RuntimeError)
+                                    else "no_capture"
+                                )
+                            ),
+                            loop=loops,
+                            test=test.name,
+                        )
+                        session.abort()
+                        crashes[test] += 1
+                        if crashes[test] > args.crash_budget:
+                            logging.error(
+                                f"{test.name} failed {crashes[test]} times, giving up"
+                                " on it"
+                            )
+                            scheduler.give_up(test)
+                            journal.event("gave_up", test=test.name)
+                        else:
+                            # Give whatever made it crash a chance to go away
+                            backoff = crash_backoff * 2 ** (crashes[test] - 1)
+                            logging.info(f"Retrying the pass in {backoff} seconds")
+                            sleep(backoff)
+                        continue
+                    journal.add_pass(test.name, test.results[-1], test.pass_info[-1])
+                    print(
+                        f"Finished pass {len(test.results) - 1} of {test.name}"
+                        + (" (anchor)" if anchor else "")
+                    )
+                    position += 1
+                # Adaptive units are one pass each, a test keeps its game until the
+                # session switches to another test or the loop ends
+                if not args.reuse_game and not args.target_ci:
+                    try:
+                        session.close()
+                    except NoSuchProcess:
+                        session.abort()
+            except KeyboardInterrupt:
+                logging.warning(
+                    "KeyboardInterrupt received. Some tests will probably end up with more passes than others."
+                )
+                journal.event("interrupted", loop=loops)
+                session.abort()
+                Journal.compact(journal.path, summary_path)
+                exit(0)
+            for test in unit_tests:
                 args.tests[test.index]["results"] = test.results
-                print(f"Finished test {test.name}")
-                success = True
-                with open(
-                    f"{args.output_file.absolute()}.json",
-                    "w",
-                    newline="",
-                    encoding="utf-8",
-                ) as outfile:
-                    json.dump(args.__dict__, outfile, default=str)
-                # test.watchdog.join()
+                args.tests[test.index]["pass_info"] = test.pass_info
+                args.tests[test.index]["stop_reason"] = test.stop_reason or (
+                    None if args.target_ci else "passes"
+                )
+                journal.set(
+                    "stop_reason",
+                    args.tests[test.index]["stop_reason"],
+                    test=test.name,
+                )
+            print(f"Finished {', '.join(test.name for test in unit_tests)}")
+            args.drift = drift_report(args)
+            journal.set("drift", args.drift)
+            if args.drift:
+                for name, drift in args.drift.items():
+                    logging.info(
+                        f"{name}: mean frametime {drift['mean']:.3f}ms, drift"
+                        f" adjusted {drift['adjusted_mean']:.3f}ms"
+                    )
+            # test.watchdog.join()
+        if not args.reuse_game and args.target_ci:
+            try:
+                session.close()
+            except NoSuchProcess:
+                session.abort()
         loops += 1
+    session.close()
+    journal.event("done")
+    journal.close()
+    # The summary is only written once, the journal has everything until then
+    Journal.compact(journal.path, summary_path)
 
     print("done")
 
@@ -740,6 +1074,58 @@ def get_user_launch_options(steam_path, gameid):
         return valve["Steam"]["apps"][gameid]["LaunchOptions"]
 
 
+def resume_options(summary):
+    """
+    Options of the job in a summary, as {option name: value} to be parsed the same as
+    the options in a job file
+    """
+    options = {}
+    for dest in RESUMED_OPTIONS:
+        value = summary.get(dest)
+        if value in ("", None):
+            continue
+        # The game path is found again from the gameid
+        if dest == "game_path" and summary.get("gameid"):
+            continue
+        if isinstance(value, list):
+            if not value:
+                continue
+            value = " ".join(str(v) for v in value)
+        options[dest.replace("_", "-")] = value
+    return options
+
+
+def name_tests(tests):
+    """Check for duplicate tests and generate test names and changes if empty"""
+    names = [n["name"] for n in tests if n.get("name") is not None]
+    if len(names) != len(set(names)):
+        raise ValueError("Multiple tests with the same name")
+
+    for t in tests:
+        if t.get("changes"):
+            if not t.get("name"):
+                concat_changes = " ".join(
+                    [
+                        " ".join([i for i in x if i is not None])
+                        for x in t["changes"].values()
+                    ]
+                )
+                if concat_changes == " ":
+                    concat_changes = "baseline"
+
+                timeout = 0
+                while timeout < 50:
+                    if concat_changes in names:
+                        concat_changes = f"{concat_changes}_{timeout}"
+                    else:
+                        names.append(concat_changes)
+                        t["name"] = concat_changes
+                        break
+                    timeout = +1
+        else:
+            t["changes"] = {}
+
+
 def try_parsing_file(path):
     file_type = str(path).split(".")[-1]
     if file_type in ("vdf", "acf"):
@@ -0,0 +1,159 @@
+import argparse
+
+import numpy as np
+
+
+def percentage(value):
+    """
+    argparse type for an "n% high" percentage, like "1" or "0.1", between 0 and
+    100. The string is returned unchanged, it names the metric
+    """
+    try:
+        prcnt = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Percentages must be floats, with '.' as decimal separator"
+        ) from None
+    if not 0 <= prcnt <= 100:
+        raise argparse.ArgumentTypeError(
+            f"Percentages must be between 0 and 100, got {value}"
+        )
+    return value
+
+
+def parse_percentages(values):
+    """
+    Check the "n% high" percentages given to a script, exiting with an argparse
+    error if any isn't a percentage, and return them unchanged
+    """
+    parser = argparse.ArgumentParser(usage="%(prog)s summary [percentage ...]")
+    parser.add_argument("percentages", nargs="*", type=percentage)
+    return parser.parse_args(list(values)).percentages
+
+
+def pass_positions(file, test):
+    """
+    Position of every pass of test within its loop, from 0, as {index in results:
+    position}. Anchor passes are left out. In merged summaries every work item ran
+    as a job of its own, so positions count within every loop of every item.
+    Summaries from before pass_info had a fixed number of passes per loop
+    """
+    infos = test.get("pass_info") or [
+        {"loop": i // file["passes"], "anchor": False}
+        for i in range(len(test["results"]))
+    ]
+    positions = {}
+    runs = {}
+    for i, info in enumerate(infos):
+        if info.get("anchor"):
+            continue
+        run = (info.get("item", info.get("rig")), info.get("loop", 0))
+        positions[i] = runs.get(run, 0)
+        runs[run] = positions[i] + 1
+    return positions
+
+
+def kept_passes(file, test):
+    """
+    Indices of the passes of test that count towards its results: the ones from
+    pass_positions past the first discard_passes of their loop
+    """
+    return [
+        i
+        for i, position in pass_positions(file, test).items()
+        if position >= file["discard_passes"]
+    ]
+
+
+def metrics(frametimes, percentages=()):
+    """Metrics of a single pass, see batch_metrics"""
+    return {k: v[0] for k, v in batch_metrics([frametimes], percentages).items()}
+
+
+def batch_metrics(passes, percentages=()):
+    """
+    Average, variance and the "n% high" frametime for every n in percentages, of
+    every pass at once. Returns {metric name: array with one value per pass}, NaN
+    for passes without frames.
+
+    Passes can have different lengths. Sums are taken over all of them joined end
+    to end with np.add.reduceat. For the quantiles the passes are padded to a
+    matrix with inf, which partitions after every real frame, and a single
+    np.partition puts every quantile of every pass in place. Quantiles are
+    interpolated linearly, like np.percentile does by default
+    """
+    lengths = np.array([len(p) for p in passes], dtype=np.intp)
+    results = {
+        "Average Frametime": np.full(len(passes), np.nan),
+        "Variance of Frametime": np.full(len(passes), np.nan),
+        **{
+            f"{n}% High of Frametime": np.full(len(passes), np.nan) for n in percentages
+        },
+    }
+    filled = np.flatnonzero(lengths)
+    if not len(filled):
+        return results
+    passes = [np.asarray(passes[i], dtype=np.float64) for i in filled]
+    lengths = lengths[filled]
+
+    joined = np.concatenate(passes)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    mean = np.add.reduceat(joined, starts) / lengths
+    deviation = joined - np.repeat(mean, lengths)
+    results["Average Frametime"][filled] = mean
+    results["Variance of Frametime"][filled] = (
+        np.add.reduceat(deviation * deviation, starts) / lengths
+    )
+    if not percentages:
+        return results
+
+    padded = np.full((len(passes), lengths.max()), np.inf)
+    for row, frames in enumerate(passes):
+        padded[row, : len(frames)] = frames
+    # Rank of every quantile in every pass, and the two ranks around it
+    q = 1 - np.array([float(n) for n in percentages]) / 100
+    rank = np.outer(lengths - 1, q)
+    low = np.floor(rank).astype(np.intp)
+    high = np.minimum(low + 1, (lengths - 1)[:, None])
+    padded.partition(np.unique(np.concatenate((low.ravel(), high.ravel()))), axis=1)
+    rows = np.arange(len(passes))[:, None]
+    below, above = padded[rows, low], padded[rows, high]
+    values = below + (above - below) * (rank - low)
+    for i, n in enumerate(percentages):
+        results[f"{n}% High of Frametime"][filled] = values[:, i]
+    return results
+
+
+def timeline(passes, width, start=0):
+    """
+    Frametimes of every pass of a test lined up in time, in buckets of width
+    seconds counted from start, usually the start buffer. passes are frametime
+    and elapsed seconds columns, as returned by frametimes.load. Returns {"time", "mean", "min", "max", "count"} arrays with
+    one value per bucket that has frames, time being the start of the bucket.
+
+    Frames are binned with integer division and aggregated with np.bincount, and
+    with np.minimum/np.maximum.reduceat once sorted by bucket, so the cost doesn't
+    depend on the number of buckets
+    """
+    frametimes = np.concatenate([np.empty(0)] + [f for f, _ in passes])
+    elapsed = np.concatenate([np.empty(0)] + [e for _, e in passes]) - start
+    buckets = np.floor(elapsed / width).astype(np.intp)
+    if not len(buckets):
+        return {k: np.empty(0) for k in ("time", "mean", "min", "max", "count")}
+    first = buckets.min()
+    buckets -= first
+
+    count = np.bincount(buckets)
+    total = np.bincount(buckets, weights=frametimes)
+    used = np.flatnonzero(count)
+
+    order = np.argsort(buckets, kind="stable")
+    frametimes = frametimes[order]
+    starts = np.concatenate(([0], np.cumsum(count[used])[:-1]))
+    return {
+        "time": (used + first) * width,
+        "mean": total[used] / count[used],
+        "min": np.minimum.reduceat(frametimes, starts),
+        "max": np.maximum.reduceat(frametimes, starts),
+        "count": count[used],
+    }
@@ -0,0 +1,392 @@
+import argparse
+import io
+import json
+import logging
+import random
+import sys
+import threading
+from argparse import Namespace
+from datetime import datetime
+from pathlib import Path
+from platform import node, platform, python_version
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep, time
+from unittest.mock import patch
+
+import numpy as np
+
+from . import get_cpu_name, vdf_patch
+from .emulator import Emulator, RconServer, build_tree
+from .fastforward import FastForward
+from .game import Game, GameState
+from .session import Session
+from .test import Test
+
+# Metrics compared against a baseline, besides throughputs ("..._per_s"), which
+# are better the higher they are. Every other one is better the lower it is. Means
+# and tails move too much from run to run to be compared
+COMPARED = ("p50", "overshoot_rate")
+
+
+def summarize(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    if not len(samples):
+        return {"samples": 0}
+    return {
+        "samples": len(samples),
+        "mean": float(samples.mean()),
+        "p50": float(np.percentile(samples, 50)),
+        "p99": float(np.percentile(samples, 99)),
+        "max": float(samples.max()),
+    }
+
+
+class TickWriter(threading.Thread):
+    """Writes dem_usercmd lines to a log at rate lines per second"""
+
+    def __init__(self, path, rate):
+        super().__init__(daemon=True)
+        self.path = path
+        self.rate = rate
+        # When each tick was written, by tick
+        self.written = {}
+        self.tick = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = perf_counter()
+        with open(self.path, "a", encoding="utf-8") as log:
+            while not self.stopped.is_set():
+                due = int((perf_counter() - start) * self.rate)
+                while self.tick < due:
+                    self.tick += 1
+                    # The game flushes every line of the console log
+                    log.write(f"{self.tick} dem_usercmd\n")
+                    log.flush()
+                    self.written[self.tick] = perf_counter()
+                sleep(min(1 / self.rate, 0.001))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Bench:
+    """
+    Measures the control path of demoknight, everything it does around a capture,
+    against an emulated game on this machine. Each benchmark returns a dict of
+    metrics, times in seconds
+    """
+
+    password = "bench"
+    names = ("rcon", "wait_for_tick", "gototick", "vdf_parse", "job_startup")
+
+    def __init__(self, work_dir, quick=False):
+        self.work_dir = Path(work_dir)
+        self.quick = quick
+        self.launcher = build_tree(self.work_dir / "game", ticks=6000)
+
+    def run(self, names=None):
+        results = {}
+        for name in names or Bench.names:
+            logging.warning(f"Running {name}")
+            tic = perf_counter()
+            results[name] = getattr(self, name)()
+            logging.warning(f"{name} took {perf_counter() - tic:.1f}s")
+        return results
+
+    def rcon(self):
+        """Round trip of a command through Game.rcon, and through the bare client"""
+        count = 200 if self.quick else 2000
+        server = RconServer(lambda command: "", 0, Bench.password).start()
+        game = Game.attach(server.port, Bench.password, self.work_dir / "rcon.log")
+        try:
+            tic = perf_counter()
+            game.rcon("echo")
+            connect = perf_counter() - tic
+            wrapped = []
+            for _ in range(count):
+                tic = perf_counter()
+                game.rcon("echo")
+                wrapped.append(perf_counter() - tic)
+            client = game._rcon_client
+            bare = []
+            for _ in range(count):
+                tic = perf_counter()
+                client.run("echo")
+                bare.append(perf_counter() - tic)
+        finally:
+            game._rcon_disconnect()
+            server.close()
+        return {
+            "connect": connect,
+            "round_trip": summarize(wrapped),
+            "client": summarize(bare),
+            "overhead": {"mean": float(np.mean(wrapped) - np.mean(bare))},
+            "commands_per_s": count / sum(wrapped),
+        }
+
+    def wait_for_tick(self):
+        """
+        Time from a tick being written to the log to _wait_for_tick returning for
+        it, for the rates the log is written at by demos at timescale 1, 10 and 100
+        """
+        waits = 10 if self.quick else 40
+        results = {}
+        for rate in (66.7, 667, 6670):
+            path = self.work_dir / f"ticks_{rate:g}.log"
+            path.write_text("")
+            game = Game.attach(0, Bench.password, path)
+            writer = TickWriter(path, rate)
+            writer.start()
+            latencies = []
+            try:
+                for _ in range(waits):
+                    # Far enough ahead to be waiting when it is written
+                    target = writer.tick + max(int(rate * 0.1), 2)
+                    game._wait_for_tick(target)
+                    reached = perf_counter()
+                    latencies.append(reached - writer.written[target])
+            finally:
+                writer.stop()
+                game.log.close()
+            results[f"{rate:g}"] = summarize(latencies)
+        return results
+
+    def gototick(self):
+        """
+        Game.gototick to random ticks of a demo played by the emulator: how long it
+        takes, how far past the tick the log is when it returns, and how often it
+        goes past the tick and has to start over. The fast-forward model starts from
+        scratch
+        """
+        rounds = 4 if self.quick else 12
+        emulator, game = self._emulator()
+        saved = FastForward.path
+        FastForward.path = self.work_dir / "fastforward.json"
+        rng = random.Random(0)
+        times, overshoots, past = [], [], 0
+        try:
+            for _ in range(rounds):
+                game.rcon("disconnect")
+                game.playdemo("demos/emulator")
+                target = rng.randint(500, 5000)
+                tic = perf_counter()
+                try:
+                    game.gototick(target, 0.015)
+                except (TimeoutError, RuntimeError) as e:
+                    logging.info(f"gototick {target} failed: {e}")
+                    past += 1
+                    continue
+                times.append(perf_counter() - tic)
+                game.log.poll()
+                overshoots.append(game.log.tick - target)
+        finally:
+            FastForward.path = saved
+            game._rcon_disconnect()
+            game.log.close()
+            emulator.close()
+        return {
+            "convergence": summarize(times),
+            "overshoot_ticks": summarize(overshoots),
+            "overshoot_rate": past / rounds,
+        }
+
+    def vdf_parse(self):
+        """vdf_patch.patched_parse on a localconfig.vdf sized file"""
+        rng = random.Random(0)
+        lines = ['"UserLocalConfigStore"', "{", '\t"apps"', "\t{"]
+        for app in rng.sample(range(10, 2000000), 3000):
+            lines += [
+                f'\t\t"{app}"',
+                "\t\t{",
+                f'\t\t\t"LastPlayed"\t\t"{rng.randint(1e9, 2e9)}"',
+                f'\t\t\t"Playtime"\t\t"{rng.randint(0, 10000)}"',
+                '\t\t\t"LaunchOptions"\t\t"-novid -console +exec \\"autoexec.cfg\\""',
+                '\t\t\t"cloud"',
+                "\t\t\t{",
+                '\t\t\t\t"last_sync_state"\t\t"synchronized"',
+                "\t\t\t}",
+                "\t\t}",
+            ]
+        text = "\n".join(lines + ["\t}", "}"]) + "\n"
+        repeats = 2 if self.quick else 10
+        times = []
+        for _ in range(repeats):
+            tic = perf_counter()
+            vdf_patch.patched_parse(io.StringIO(text))
+            times.append(perf_counter() - tic)
+        best = min(times)
+        return {
+            "parse": summarize(times),
+            "bytes_per_s": len(text.encode()) / best,
+            "lines_per_s": len(lines) / best,
+        }
+
+    def job_startup(self):
+        """
+        From a test asking for a game to the game being ready for it, with the
+        emulator as the game: the launch until the watchdog sees it running, and the
+        readiness checks after it
+        """
+        runs = 1 if self.quick else 3
+        args = Namespace(
+            tests=[{"name": "bench", "changes": {}}],
+            launch_options=(),
+            gameid=0,
+            game_path=self.launcher,
+            steam_path=None,
+            raw_path=self.work_dir / "raw",
+            output_file="bench",
+            duration=1,
+            start_buffer=0,
+            ready_confidence=0.95,
+        )
+        # The emulator's mangohud is found through PATH
+        path = f"{self.launcher.parent / 'bin'}:{Test.game_environ.get('PATH', '')}"
+        launch, ready = [], []
+        with patch.dict(Test.game_environ, PATH=path):
+            for _ in range(runs):
+                session = Session(args)
+                tic = time()
+                session.open(Test(args, 0))
+                done = time()
+                running = next(
+                    t
+                    for t, state in session.game.state_history
+                    if state == GameState.RUNNING
+                )
+                launch.append(running - tic)
+                ready.append(done - running)
+                session.game.quit()
+        return {
+            "launch": summarize(launch),
+            "ready": summarize(ready),
+            "total": summarize(np.add(launch, ready)),
+        }
+
+    def _emulator(self):
+        """An emulator answering rcon and playing demos in this process"""
+        emulator = Emulator(
+            self.launcher,
+            [
+                "+con_logfile",
+                "demoknight.log",
+                "-conclearlog",
+                "+rcon_password",
+                Bench.password,
+                "+hostport",
+                "0",
+            ],
+        )
+        emulator.load_time = 0
+        emulator.serve()
+        game = Game.attach(
+            emulator.rcon.port,
+            Bench.password,
+            emulator.mod_path / emulator.cvars["con_logfile"],
+        )
+        return emulator, game
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}/"))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """
+    Metrics of results that got worse than in baseline by more than tolerance, as
+    (metric, baseline value, value) tuples
+    """
+    old = flatten(baseline)
+    regressions = []
+    for key, value in flatten(results).items():
+        name = key.rsplit("/", 1)[-1]
+        higher = name.endswith("_per_s")
+        if not (higher or name in COMPARED) or key not in old:
+            continue
+        before = old[key]
+        if higher:
+            worse = value < before * (1 - tolerance)
+        else:
+            # Overshoot rates can start at 0
+            worse = value > before * (1 + tolerance) and value - before > 1e-6
+        if worse:
+            regressions.append((key, before, value))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m demoknight.bench",
+        description=(
+            "Measure demoknight's own control logic against an emulated game, and"
+            " compare it with an earlier run"
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        type=Path,
+        default=Path(f"bench_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"),
+        help="Default: %(default)s",
+    )
+    parser.add_argument(
+        "-b", "--baseline", type=Path, help="Results of an earlier run to compare to"
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=0.5,
+        type=float,
+        help=(
+            "How much worse than the baseline a metric can get before it counts as a"
+            " regression, relative to the baseline. Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=Bench.names,
+        help="Benchmarks to run. Default: all of them",
+    )
+    parser.add_argument("--quick", action="store_true", help="Take fewer samples")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    with TemporaryDirectory(prefix="demoknight_bench_") as work_dir:
+        results = Bench(work_dir, args.quick).run(args.only)
+    output = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "node": node(),
+            "cpu": get_cpu_name(),
+            "platform": platform(),
+            "python": python_version(),
+        },
+        "quick": args.quick,
+        "results": results,
+    }
+    with open(args.output_file, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=1)
+    print(f"Results written to {args.output_file}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for key, before, value in regressions:
+            print(f"Regression in {key}: {before:.6g} -> {value:.6g}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
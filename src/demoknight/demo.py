@@ -0,0 +1,364 @@
+import json
+import logging
+import mmap
+import os
+import struct
+from collections import namedtuple
+from pathlib import Path
+from tempfile import gettempdir
+
+import numpy as np
+
+# Source engine demo header, see "demofile.h" in the Source SDK
+HEADER = struct.Struct("<8sii260s260s260s260sfiii")
+MAGIC = b"HL2DEMO\x00"
+
+HEADER_CACHE = Path(gettempdir()) / "demoknight" / "demo_headers.json"
+
+
+class DemoHeader(
+    namedtuple(
+        "DemoHeader",
+        (
+            "demo_protocol",
+            "network_protocol",
+            "server_name",
+            "client_name",
+            "map_name",
+            "game_directory",
+            "playback_time",
+            "ticks",
+            "frames",
+            "signon_length",
+        ),
+    )
+):
+    @property
+    def tick_interval(self):
+        """Server tick interval, rounded off the float32 noise of playback_time"""
+        if not self.ticks or self.playback_time <= 0:
+            return None
+        return round(self.playback_time / self.ticks, 6)
+
+
+def read_header(path):
+    """Parse the header of a .dem file without reading the rest of it"""
+    with open(path, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            raise ValueError(f"{path} is empty") from e
+        with m:
+            if len(m) < HEADER.size or m[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a Source engine demo")
+            fields = HEADER.unpack_from(m)
+    return DemoHeader(
+        *(
+            (
+                field.split(b"\x00", 1)[0].decode("utf-8", "replace")
+                if isinstance(field, bytes)
+                else field
+            )
+            for field in fields[1:]
+        )
+    )
+
+
+def cache_key(path):
+    """
+    Identifies a version of a demo file by its path, size and modification time, so
+    telling whether it changed doesn't take reading it
+    """
+    stat = os.stat(path)
+    return f"{Path(path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def load_header(path):
+    """read_header, cached by cache_key"""
+    digest = cache_key(path)
+    try:
+        with open(HEADER_CACHE, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if digest in cache:
+        return DemoHeader(**cache[digest])
+
+    header = read_header(path)
+    cache[digest] = header._asdict()
+    try:
+        HEADER_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with open(HEADER_CACHE, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=1)
+    except OSError as e:
+        logging.info(f"Could not cache the header of {path}: {e}")
+    return header
+
+
+def find_demo_file(game_path, demo_path):
+    """
+    Resolve demo_path the way 'playdemo' does, relative to the game's mod directories
+    """
+    demo_path = Path(demo_path)
+    if demo_path.suffix != ".dem":
+        demo_path = demo_path.with_name(demo_path.name + ".dem")
+    if demo_path.is_absolute():
+        return demo_path if demo_path.is_file() else None
+    for gameinfo in Path(game_path).parent.glob("./*/gameinfo.txt"):
+        candidate = gameinfo.parent / demo_path
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+# Demo frame commands
+DEM_SIGNON = 1
+DEM_PACKET = 2
+DEM_SYNCTICK = 3
+DEM_CONSOLECMD = 4
+DEM_USERCMD = 5
+DEM_DATATABLES = 6
+DEM_STOP = 7
+DEM_CUSTOMDATA = 8
+
+NETMSG_TYPE_BITS = 6
+
+# Per-tick workload, see build_workload_index
+WORKLOAD_DTYPE = np.dtype(
+    [
+        ("tick", np.int32),
+        ("bytes", np.uint32),
+        ("entities", np.uint32),
+        ("sounds", np.uint16),
+        ("tempents", np.uint16),
+        ("usermessages", np.uint16),
+        # Packets with a message the parser doesn't know how to skip are only
+        # counted up to that message
+        ("partial", np.bool_),
+    ]
+)
+
+
+class BitReader:
+    """Little-endian bit reader over the payload of a demo packet"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.size = len(data) * 8
+
+    def read(self, bits):
+        if self.pos + bits > self.size:
+            raise EOFError
+        start = self.pos >> 3
+        value = int.from_bytes(self.data[start : start + 8], "little")
+        value = (value >> (self.pos & 7)) & ((1 << bits) - 1)
+        self.pos += bits
+        return value
+
+    def skip(self, bits):
+        if self.pos + bits > self.size:
+            raise EOFError
+        self.pos += bits
+
+    def skip_string(self):
+        while self.read(8):
+            pass
+
+
+def _skip_message(reader, msg_type, counts):
+    """
+    Skip one net message of an Orange Box/Source 2013 packet, counting the workload
+    ones. Returns False for messages that can't be skipped without decoding them
+    """
+    read, skip = reader.read, reader.skip
+    if msg_type == 0:  # net_NOP
+        pass
+    elif msg_type in (1, 4, 7):  # net_Disconnect, net_StringCmd, svc_Print
+        reader.skip_string()
+    elif msg_type == 2:  # net_File
+        skip(32)
+        reader.skip_string()
+        skip(1)
+    elif msg_type == 3:  # net_Tick
+        skip(64)
+    elif msg_type == 5:  # net_SetConVar
+        for _ in range(read(8) * 2):
+            reader.skip_string()
+    elif msg_type == 6:  # net_SignonState
+        skip(40)
+    elif msg_type == 9:  # svc_SendTable
+        skip(1)
+        skip(read(16))
+    elif msg_type == 11:  # svc_SetPause
+        skip(1)
+    elif msg_type == 13:  # svc_UpdateStringTable
+        skip(5)
+        skip(16 if read(1) else 0)
+        skip(read(20))
+    elif msg_type == 15:  # svc_VoiceData
+        skip(16)
+        skip(read(16))
+    elif msg_type == 17:  # svc_Sounds
+        if read(1):
+            counts["sounds"] += 1
+            skip(read(8))
+        else:
+            counts["sounds"] += read(8)
+            skip(read(16))
+    elif msg_type == 18:  # svc_SetView
+        skip(11)
+    elif msg_type == 19:  # svc_FixAngle
+        skip(49)
+    elif msg_type == 20:  # svc_CrosshairAngle
+        skip(48)
+    elif msg_type == 23:  # svc_UserMessage
+        counts["usermessages"] += 1
+        skip(8)
+        skip(read(11))
+    elif msg_type == 24:  # svc_EntityMessage
+        skip(20)
+        skip(read(11))
+    elif msg_type == 25:  # svc_GameEvent
+        skip(read(11))
+    elif msg_type == 26:  # svc_PacketEntities
+        skip(11)
+        skip(32 if read(1) else 0)
+        skip(1)
+        counts["entities"] += read(11)
+        length = read(20)
+        skip(1)
+        skip(length)
+    elif msg_type == 27:  # svc_TempEntities
+        counts["tempents"] += read(8)
+        skip(read(17))
+    elif msg_type == 28:  # svc_Prefetch
+        skip(14)
+    elif msg_type == 29:  # svc_Menu
+        skip(16)
+        skip(read(16) * 8)
+    elif msg_type == 30:  # svc_GameEventList
+        skip(9)
+        skip(read(20))
+    elif msg_type == 31:  # svc_GetCvarValue
+        skip(32)
+        reader.skip_string()
+    elif msg_type == 32:  # svc_CmdKeyValues
+        skip(read(32) * 8)
+    else:
+        # svc_ServerInfo, svc_ClassInfo, svc_CreateStringTable, svc_BSPDecal...
+        return False
+    return True
+
+
+def _count_packet(data, counts):
+    reader = BitReader(data)
+    try:
+        while reader.size - reader.pos >= NETMSG_TYPE_BITS:
+            if not _skip_message(reader, reader.read(NETMSG_TYPE_BITS), counts):
+                return False
+    except EOFError:
+        return False
+    return True
+
+
+def build_workload_index(path):
+    """
+    Walk a .dem file once and record, for every tick, how many bytes of packets it
+    has, how many entities they update and how many sounds, temp entities and user
+    messages they carry
+    """
+    header = read_header(path)
+    # Newer protocols (CS:GO) have a player slot in every frame, and two split
+    # screen slots of command info in every packet
+    slotted = header.demo_protocol >= 4
+    cmdinfo_size = 76 * (2 if slotted else 1)
+    stringtables = 9 if slotted else 8
+
+    ticks = {}
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        pos = HEADER.size
+        end = len(m)
+        while pos + 5 <= end:
+            cmd, tick = struct.unpack_from("<Bi", m, pos)
+            pos += 5 + slotted
+            if cmd == DEM_STOP:
+                break
+            elif cmd == DEM_SYNCTICK:
+                continue
+            elif cmd in (DEM_SIGNON, DEM_PACKET):
+                pos += cmdinfo_size + 8
+                (length,) = struct.unpack_from("<i", m, pos)
+                pos += 4
+                counts = ticks.setdefault(
+                    tick,
+                    dict.fromkeys(
+                        ("bytes", "entities", "sounds", "tempents", "usermessages"), 0
+                    ),
+                )
+                counts["bytes"] += length
+                if not _count_packet(m[pos : pos + length], counts):
+                    counts["partial"] = True
+                pos += length
+            elif cmd == DEM_USERCMD:
+                (length,) = struct.unpack_from("<i", m, pos + 4)
+                pos += 8 + length
+            elif cmd in (DEM_CONSOLECMD, DEM_DATATABLES, stringtables):
+                (length,) = struct.unpack_from("<i", m, pos)
+                pos += 4 + length
+            elif cmd == DEM_CUSTOMDATA and slotted:
+                (length,) = struct.unpack_from("<i", m, pos + 4)
+                pos += 8 + length
+            else:
+                logging.warning(f"Unknown demo command {cmd} at byte {pos}, stopping")
+                break
+
+    index = np.zeros(len(ticks), dtype=WORKLOAD_DTYPE)
+    for i, tick in enumerate(sorted(ticks)):
+        counts = ticks[tick]
+        index[i] = (
+            tick,
+            counts["bytes"],
+            counts["entities"],
+            min(counts["sounds"], 0xFFFF),
+            min(counts["tempents"], 0xFFFF),
+            min(counts["usermessages"], 0xFFFF),
+            counts.get("partial", False),
+        )
+    return index
+
+
+def workload_index_path(path):
+    path = Path(path)
+    return path.with_name(path.name + ".workload.npy")
+
+
+def workload_index(path):
+    """
+    build_workload_index, stored as <demo>.workload.npy next to the demo and rebuilt
+    when the demo is newer than it
+    """
+    index_path = workload_index_path(path)
+    if index_path.exists() and index_path.stat().st_mtime >= Path(path).stat().st_mtime:
+        return np.load(index_path)
+    index = build_workload_index(path)
+    try:
+        np.save(index_path, index)
+    except OSError as e:
+        logging.info(f"Could not store the workload index of {path}: {e}")
+    return index
+
+
+def densest_window(index, length, field="entities"):
+    """
+    Start tick of the `length` ticks long window with the highest total of `field`
+    """
+    if not len(index):
+        return 0
+    first = int(index["tick"][0])
+    dense = np.zeros(int(index["tick"][-1]) - first + 1, dtype=np.int64)
+    dense[index["tick"] - first] = index[field]
+    if len(dense) <= length:
+        return first
+    sums = np.convolve(dense, np.ones(length, dtype=np.int64), mode="valid")
+    return first + int(np.argmax(sums))
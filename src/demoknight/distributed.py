@@ -0,0 +1,542 @@
+import argparse
+import hmac
+import json
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import threading
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from platform import platform
+from tempfile import gettempdir
+from time import sleep, time
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote, unquote
+from urllib.request import Request, urlopen
+
+from . import frametimes, get_cpu_name, get_gpu_name, name_tests, try_parsing_file
+
+
+class Coordinator:
+    """
+    Splits a job into work items, hands them out to agents over HTTP and merges what
+    they send back into one summary.
+
+    A work item is one loop of a chunk of the job's tests, and runs on an agent as a
+    job of its own, so every item has its own baseline from the same rig. Items
+    handed out and not reported back within `lease` seconds go back in the queue,
+    until an item has been handed out `attempts` times and is given up on.
+
+    When there is a token, every request has to carry it in an X-Demoknight-Token
+    header.
+
+    Endpoints, all JSON except captures:
+
+    - POST /agents {"name", "system"}: register, returns {"agent"}
+    - POST /work {"agent"}: returns {"item"}, or {"item": null, "done"}
+    - PUT /captures/<item>/<test>/<file>: upload a capture file
+    - POST /results {"agent", "item", "summary"}: finish an item
+    - POST /failed {"agent", "item", "error"}: give an item back
+    """
+
+    def __init__(
+        self,
+        job,
+        output_file,
+        raw_path,
+        tests_per_item=0,
+        lease=14400,
+        attempts=3,
+        token=None,
+    ):
+        self.job = job
+        self.output_file = Path(output_file)
+        self.raw_path = raw_path.absolute() / self.output_file.name
+        self.lease = lease
+        self.attempts = attempts
+        self.token = token
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.agents = {}
+        self.items = {}
+        self.queue = []
+        self.leases = {}
+        self.summaries = {}
+        self.handed_out = Counter()
+        self.gave_up = {}
+
+        tests = job.get("tests") or []
+        # Named here so that captures can be checked against the tests of their item
+        baseline = [] if job.get("no-baseline") else [{"name": "baseline"}]
+        name_tests(baseline + tests)
+        # Agents get the job without its tests, and the tests of their item
+        shared = {k: v for k, v in job.items() if k != "tests"}
+        size = tests_per_item or len(tests) or 1
+        chunks = [tests[i : i + size] for i in range(0, len(tests), size)] or [[]]
+        loops = int(job.get("loops") or 1)
+        if loops < 1:
+            raise ValueError("Distributed jobs need a finite number of --loops")
+        for loop in range(loops):
+            for chunk in chunks:
+                item = len(self.items)
+                self.items[item] = {
+                    "id": item,
+                    "loop": loop,
+                    "tests": chunk,
+                    "job": shared,
+                }
+                self.queue.append(item)
+        logging.info(f"Job split in {len(self.items)} work items")
+
+    def register(self, name, system):
+        with self.lock:
+            agent = f"{name}-{len(self.agents)}" if name in self.agents else name
+            self.agents[agent] = {"system": system, "told_done": False}
+        logging.info(f"Agent {agent} registered: {system}")
+        return agent
+
+    def work(self, agent):
+        """Next item for agent, as a job file, or None"""
+        with self.lock:
+            now = time()
+            for item, (holder, since) in list(self.leases.items()):
+                if now - since > self.lease:
+                    logging.warning(f"{holder} took too long with item {item}")
+                    del self.leases[item]
+                    self._retry(item, f"{holder} took too long")
+            if not self.queue:
+                if self.finished.is_set():
+                    self.agents[agent]["told_done"] = True
+                return None
+            item = self.queue.pop(0)
+            self.leases[item] = (agent, now)
+            self.handed_out[item] += 1
+        logging.info(f"Item {item} handed to {agent}")
+        return self.items[item]
+
+    def capture(self, item, test, name, data):
+        if item not in self.items:
+            raise ValueError(f"No item {item}")
+        tests = [t["name"] for t in self.items[item]["tests"]]
+        if not self.job.get("no-baseline"):
+            tests.append("baseline")
+        if test not in tests:
+            raise ValueError(f"No test {test} in item {item}")
+        root = self.raw_path.resolve()
+        folder = (root / self._holder(item) / test).resolve()
+        if root not in folder.parents or Path(name).name in ("", ".", ".."):
+            raise ValueError(f"Capture {name} of {test} would land outside {root}")
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / Path(name).name
+        with open(path, "wb") as f:
+            f.write(data)
+        frametimes.write_columns(path)
+        return path
+
+    def result(self, agent, item, summary):
+        with self.lock:
+            if self.leases.get(item, (None,))[0] != agent:
+                logging.warning(f"Result for item {item} from {agent} wasn't expected")
+                return
+            del self.leases[item]
+            self.summaries[item] = (agent, summary)
+            self._write(self.merge())
+            self._check_finished()
+        logging.info(f"Item {item} done by {agent}")
+
+    def failed(self, agent, item, error):
+        logging.error(f"{agent} failed item {item}: {error}")
+        with self.lock:
+            if self.leases.get(item, (None,))[0] == agent:
+                del self.leases[item]
+                self._retry(item, error)
+
+    def merge(self):
+        """
+        One summary out of every item done so far. Each pass is tagged with the rig,
+        loop and item it belongs to, rigs has the system of every rig and failed_items the
+        items given up on
+        """
+        merged = None
+        tests = {}
+        for item in sorted(self.summaries):
+            agent, summary = self.summaries[item]
+            if merged is None:
+                merged = {
+                    k: v for k, v in summary.items() if k not in ("tests", "drift")
+                }
+                merged["loops"] = int(self.job.get("loops") or 1)
+                merged["output_file"] = str(self.output_file)
+                merged["rigs"] = {}
+                merged["tests"] = []
+            merged["rigs"][agent] = (
+                summary.get("system") or self.agents[agent]["system"]
+            )
+            for test in summary["tests"]:
+                if test["name"] not in tests:
+                    entry = {k: test[k] for k in ("name", "changes") if k in test}
+                    entry.update(results=[], pass_info=[])
+                    tests[test["name"]] = entry
+                    merged["tests"].append(entry)
+                entry = tests[test["name"]]
+                for result, info in zip(test["results"], test["pass_info"]):
+                    entry["results"].append(
+                        str(self.raw_path / agent / test["name"] / Path(result).name)
+                    )
+                    entry["pass_info"].append(
+                        {
+                            **info,
+                            "loop": self.items[item]["loop"],
+                            "rig": agent,
+                            "item": item,
+                        }
+                    )
+        if merged is None:
+            merged = {
+                "loops": int(self.job.get("loops") or 1),
+                "output_file": str(self.output_file),
+                "rigs": {},
+                "tests": [],
+            }
+        merged["failed_items"] = {
+            str(item): {
+                "loop": self.items[item]["loop"],
+                "tests": [t["name"] for t in self.items[item]["tests"]],
+                "error": error,
+            }
+            for item, error in self.gave_up.items()
+        }
+        return merged
+
+    def serve(self, host, port):
+        class Handler(CoordinatorHandler):
+            coordinator = self
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Coordinator listening on {host}:{server.server_port}")
+        try:
+            self.finished.wait()
+            # Let the agents that are polling hear that the job is over
+            deadline = time() + 30
+            while time() < deadline and not all(
+                a["told_done"] for a in self.agents.values()
+            ):
+                sleep(0.5)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def _retry(self, item, error):
+        """Put item back in the queue, or give up on it. Needs the lock"""
+        if self.handed_out[item] < self.attempts:
+            self.queue.append(item)
+            return
+        logging.error(
+            f"Item {item} failed {self.handed_out[item]} times, giving up on it"
+        )
+        self.gave_up[item] = error
+        self._write(self.merge())
+        self._check_finished()
+
+    def _check_finished(self):
+        if len(self.summaries) + len(self.gave_up) == len(self.items):
+            self.finished.set()
+
+    def _holder(self, item):
+        with self.lock:
+            return self.leases.get(item, ("unknown",))[0]
+
+    def _write(self, merged):
+        path = Path(f"{self.output_file.absolute()}.json")
+        temp = path.with_name(path.name + ".tmp")
+        with open(temp, "w", newline="", encoding="utf-8") as outfile:
+            json.dump(merged, outfile, default=str)
+        os.replace(temp, path)
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    coordinator = None
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        body = json.loads(self._body() or b"{}")
+        c = self.coordinator
+        if self.path == "/agents":
+            self._reply({"agent": c.register(body["name"], body.get("system"))})
+        elif self.path == "/work":
+            item = c.work(body["agent"])
+            self._reply({"item": item, "done": c.finished.is_set()})
+        elif self.path == "/results":
+            c.result(body["agent"], body["item"], body["summary"])
+            self._reply({})
+        elif self.path == "/failed":
+            c.failed(body["agent"], body["item"], body.get("error"))
+            self._reply({})
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        parts = self.path.split("/")
+        if len(parts) != 5 or parts[1] != "captures":
+            self.send_error(404)
+            return
+        _, _, item, test, name = (unquote(p) for p in parts)
+        try:
+            self.coordinator.capture(int(item), test, name, self._body())
+        except ValueError as e:
+            logging.warning(f"Rejected capture from {self.address_string()}: {e}")
+            self.send_error(400, str(e))
+            return
+        self._reply({})
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _authorized(self):
+        token = self.coordinator.token
+        if token and not hmac.compare_digest(
+            self.headers.get("X-Demoknight-Token", ""), token
+        ):
+            self.send_error(403)
+            return False
+        return True
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _reply(self, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Agent:
+    """
+    Runs the work items of a coordinator as demoknight jobs on this machine, and
+    sends back their summaries and captures
+    """
+
+    poll_interval = 5
+
+    def __init__(self, url, name, work_dir, command, token=None):
+        self.url = url.rstrip("/")
+        self.name = name
+        self.work_dir = work_dir.absolute()
+        self.command = command
+        self.token = token
+        self.agent = None
+
+    def run(self):
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.agent = self._post(
+            "/agents", {"name": self.name, "system": Agent.system()}
+        )["agent"]
+        logging.info(f"Registered as {self.agent}")
+        while True:
+            reply = self._post("/work", {"agent": self.agent})
+            item = reply["item"]
+            if item is None:
+                if reply["done"]:
+                    return
+                sleep(self.poll_interval)
+                continue
+            try:
+                summary = self.run_item(item)
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                logging.error(f"Item {item['id']} failed: {e}")
+                self._post(
+                    "/failed",
+                    {"agent": self.agent, "item": item["id"], "error": str(e)},
+                )
+                continue
+            self._post(
+                "/results",
+                {"agent": self.agent, "item": item["id"], "summary": summary},
+            )
+
+    def run_item(self, item):
+        """Run a work item as a job of its own and upload its captures"""
+        output_file = self.work_dir / f"item_{item['id']}"
+        job = {k: v for k, v in item["job"].items() if k != "tests"}
+        job.update(
+            {
+                "loops": 1,
+                "output-file": str(output_file),
+                "raw-path": str(self.work_dir / "raw"),
+                "tests": item["tests"],
+            }
+        )
+        job_file = self.work_dir / f"item_{item['id']}.json"
+        with open(job_file, "w", encoding="utf-8") as f:
+            json.dump(job, f, default=str)
+        logging.info(f"Running item {item['id']}")
+        subprocess.run(self.command + ["--job-file", str(job_file)], check=True)
+
+        with open(f"{output_file}.json", encoding="utf-8") as f:
+            summary = json.load(f)
+        for test in summary["tests"]:
+            for result in test.get("results", []):
+                with open(result, "rb") as f:
+                    self._put(
+                        f"/captures/{item['id']}/{quote(test['name'], safe='')}"
+                        f"/{quote(Path(result).name, safe='')}",
+                        f.read(),
+                    )
+        return summary
+
+    @staticmethod
+    def system():
+        return {"CPU": get_cpu_name(), "GPU": get_gpu_name(), "OS": platform()}
+
+    def _post(self, path, data):
+        return self._request(path, json.dumps(data, default=str).encode(), "POST")
+
+    def _put(self, path, data):
+        return self._request(path, data, "PUT")
+
+    def _request(self, path, data, method):
+        # Ride out coordinator restarts and network hiccups for a while
+        for attempt in range(10):
+            try:
+                request = Request(self.url + path, data=data, method=method)
+                if self.token:
+                    request.add_header("X-Demoknight-Token", self.token)
+                with urlopen(request, timeout=60) as response:
+                    return json.loads(response.read() or b"{}")
+            except HTTPError:
+                # The coordinator is there and turned the request down
+                raise
+            except (URLError, ConnectionError, socket.timeout) as e:
+                if attempt == 9:
+                    raise
+                logging.warning(f"Coordinator unreachable ({e}), retrying")
+                sleep(self.poll_interval)
+
+
+def coordinator(argv):
+    parser = argparse.ArgumentParser(
+        prog="demoknight coordinator",
+        description="Split a job across demoknight agents and merge their results",
+    )
+    parser.add_argument(
+        "-j", "--job-file", required=True, help="Job to split, see --job-file"
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="Default: %(default)s")
+    parser.add_argument("--port", default=8765, type=int, help="Default: %(default)s")
+    parser.add_argument(
+        "--tests-per-item",
+        default=0,
+        type=int,
+        help=(
+            "Tests in each work item, every item being one loop of them plus the"
+            " baseline. 0 for all of them. Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "--lease",
+        default=14400,
+        type=float,
+        help=(
+            "Seconds an agent has to finish an item before it is handed to another"
+            " one. Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "--attempts",
+        default=3,
+        type=int,
+        help=(
+            "Times an item is handed out, failing or running past --lease, before it"
+            " is given up on. Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("DEMOKNIGHT_TOKEN"),
+        help=(
+            "Shared secret agents have to send with every request, none if unset."
+            " Default: the DEMOKNIGHT_TOKEN environment variable"
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        type=Path,
+        default=Path(f"merged_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"),
+        help="Path for the merged summary. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--raw-path",
+        type=Path,
+        default=Path(gettempdir()) / "demoknight",
+        help="Where the captures sent by agents are stored. Default: %(default)s",
+    )
+    args = parser.parse_args(argv)
+
+    coord = Coordinator(
+        try_parsing_file(args.job_file) or {},
+        args.output_file,
+        args.raw_path,
+        args.tests_per_item,
+        args.lease,
+        args.attempts,
+        args.token,
+    )
+    coord.serve(args.host, args.port)
+    print(f"done, merged summary in {args.output_file.absolute()}.json")
+
+
+def agent(argv):
+    parser = argparse.ArgumentParser(
+        prog="demoknight agent",
+        description="Run work items from a demoknight coordinator",
+    )
+    parser.add_argument(
+        "coordinator", help="URL of the coordinator, like http://host:8765"
+    )
+    parser.add_argument(
+        "--name",
+        default=socket.gethostname(),
+        help="Name of this rig in the merged results. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=Path(gettempdir()) / "demoknight_agent",
+        help="Where job files, summaries and captures go. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--command",
+        default="demoknight",
+        help=(
+            "Command that runs a job, given --job-file. Can be replaced to run items"
+            " against a fake game. Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("DEMOKNIGHT_TOKEN"),
+        help=(
+            "Shared secret the coordinator was started with. Default: the"
+            " DEMOKNIGHT_TOKEN environment variable"
+        ),
+    )
+    args = parser.parse_args(argv)
+    Agent(
+        args.coordinator,
+        args.name,
+        args.work_dir,
+        shlex.split(args.command),
+        args.token,
+    ).run()
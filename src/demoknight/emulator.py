@@ -0,0 +1,694 @@
+import argparse
+import logging
+import os
+import random
+import shlex
+import site
+import socket
+import struct
+import sys
+import threading
+from datetime import datetime
+from math import pi, sin
+from pathlib import Path
+from time import perf_counter, sleep
+
+from .demo import DEM_PACKET, DEM_STOP, HEADER, MAGIC, find_demo_file, read_header
+
+# Source rcon packet types, see https://developer.valvesoftware.com/wiki/Source_RCON_Protocol
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+
+def workload(tick):
+    """
+    Relative cost of rendering a tick of the emulated demo, 1 on average. The
+    generated demo has as many entity updates per tick as this says, so the
+    workload index of the demo and the frametimes of the emulator agree
+    """
+    return 1 + 0.35 * sin(2 * pi * tick / 400) + 0.15 * sin(2 * pi * tick / 97)
+
+
+def split_commands(text):
+    """Split console input into statements on ';' and newlines outside of quotes"""
+    statements = []
+    current = []
+    quoted = False
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif char in ";\n" and not quoted:
+            statements.append("".join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    statements.append("".join(current).strip())
+    return [s for s in statements if s]
+
+
+class RconServer:
+    """
+    Source rcon over TCP, answering every command with console(command). Responses
+    over 4096 bytes are split in several packets with the id of the command, and the
+    empty packet clients send after one to find the end of it is mirrored back.
+
+    The game sends an empty response before the auth response, which the rcon
+    client can lose in its read buffer and then wait forever for the second one, so
+    only the auth response is sent
+    """
+
+    packet_limit = 4096
+
+    def __init__(self, console, port, password, host="127.0.0.1"):
+        self.console = console
+        self.password = password
+        self.server = socket.create_server((host, port))
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        authed = False
+        with conn, conn.makefile("rb") as stream:
+            while True:
+                try:
+                    packet = RconServer.read_packet(stream)
+                except (EOFError, OSError):
+                    break
+                request_id, kind, body = packet
+                try:
+                    if kind == SERVERDATA_AUTH:
+                        authed = bool(self.password) and body == self.password
+                        conn.sendall(
+                            RconServer.packet(
+                                request_id if authed else -1, SERVERDATA_AUTH_RESPONSE
+                            )
+                        )
+                    elif not authed:
+                        break
+                    elif kind == SERVERDATA_EXECCOMMAND:
+                        response = self.console(body).encode()
+                        conn.sendall(
+                            b"".join(
+                                RconServer.packet(
+                                    request_id,
+                                    SERVERDATA_RESPONSE_VALUE,
+                                    response[i : i + self.packet_limit],
+                                )
+                                for i in range(
+                                    0, max(len(response), 1), self.packet_limit
+                                )
+                            )
+                        )
+                    else:
+                        conn.sendall(
+                            RconServer.packet(request_id, SERVERDATA_RESPONSE_VALUE)
+                        )
+                except OSError:
+                    break
+
+    @staticmethod
+    def packet(request_id, kind, body=b""):
+        payload = struct.pack("<ii", request_id, kind) + body + b"\x00\x00"
+        return struct.pack("<i", len(payload)) + payload
+
+    @staticmethod
+    def read_packet(stream):
+        """Read one packet, returning its id, type and body as a str"""
+        head = stream.read(4)
+        if len(head) < 4:
+            raise EOFError
+        (size,) = struct.unpack("<i", head)
+        payload = stream.read(size)
+        if len(payload) < size or size < 10:
+            raise EOFError
+        request_id, kind = struct.unpack_from("<ii", payload)
+        return request_id, kind, payload[8:-2].decode("utf-8", "replace")
+
+
+class MangoHud:
+    """
+    The part of MangoHud demoknight talks to: the control socket named by the
+    config's `control`, and logging every frame to a CSV in `output_folder` for up
+    to `log_duration` seconds
+    """
+
+    flush_interval = 0.25
+    header = (
+        "os,cpu,gpu,ram,kernel,driver,cpuscheduler\n"
+        "Linux,Emulated CPU,Emulated GPU,0,emulator,emulator,\n"
+        "fps,frametime,cpu_load,gpu_load,cpu_temp,gpu_temp,gpu_core_clock,"
+        "gpu_mem_clock,gpu_vram_used,gpu_power,ram_used,swap_used,process_rss,"
+        "elapsed\n"
+    )
+
+    def __init__(self, conf_path, program):
+        self.program = program
+        self.conf = {}
+        with open(conf_path, encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                if key and not key.startswith("#"):
+                    self.conf[key.strip()] = value.strip()
+        self.output_folder = Path(self.conf.get("output_folder") or Path.cwd())
+        self.log_duration = float(self.conf.get("log_duration") or 0)
+        self.lock = threading.Lock()
+        self.file = None
+        self.rows = []
+        self.started = 0
+        self.flushed = 0
+
+    def serve(self):
+        """Listen on the control socket, if the config has one"""
+        name = self.conf.get("control")
+        if not name:
+            return
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind("\0" + name)
+        server.listen()
+        threading.Thread(target=self._accept, args=(server,), daemon=True).start()
+
+    def start(self):
+        with self.lock:
+            if self.file is not None:
+                return
+            self.output_folder.mkdir(parents=True, exist_ok=True)
+            stamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            path = self.output_folder / f"{self.program}_{stamp}.csv"
+            logging.info(f"Logging frames to {path}")
+            self.file = open(path, "w", encoding="utf-8")
+            self.file.write(self.header)
+            self.file.flush()
+            self.started = self.flushed = perf_counter()
+
+    def stop(self):
+        with self.lock:
+            self._stop()
+
+    def frame(self, frametime):
+        """Log a frame of frametime milliseconds that just ended"""
+        with self.lock:
+            if self.file is None:
+                return
+            now = perf_counter()
+            elapsed = now - self.started
+            self.rows.append(
+                f"{1000 / frametime:.0f},{frametime:.6f},0,0,0,0,0,0,0,0,0,0,0,"
+                f"{elapsed * 1e9:.0f}\n"
+            )
+            if self.log_duration and elapsed >= self.log_duration:
+                self._stop()
+            elif now - self.flushed >= self.flush_interval:
+                self._flush(now)
+
+    def _flush(self, now):
+        self.file.write("".join(self.rows))
+        self.file.flush()
+        self.rows = []
+        self.flushed = now
+
+    def _stop(self):
+        if self.file is None:
+            return
+        self._flush(perf_counter())
+        self.file.close()
+        self.file = None
+
+    def _accept(self, server):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self._control, args=(conn,), daemon=True).start()
+
+    def _control(self, conn):
+        with conn:
+            conn.sendall(
+                b":MangoHudVersion=1;:DeviceName=Emulated GPU;:MesaVersion=emulator;"
+            )
+            buffer = b""
+            while True:
+                try:
+                    data = conn.recv(1024)
+                except OSError:
+                    break
+                if not data:
+                    break
+                buffer += data
+                while b";" in buffer:
+                    message, buffer = buffer.split(b";", 1)
+                    command, _, param = message.lstrip(b":").partition(b"=")
+                    if command != b"logging":
+                        continue
+                    if param == b"1" or (not param and self.file is None):
+                        self.start()
+                    else:
+                        self.stop()
+
+
+class Emulator:
+    """
+    A headless stand-in for a Source game, for running demoknight end to end without
+    Steam, MangoHud or a GPU. It takes the game's launch options and answers rcon
+    with a console that has cvars, exec, echo, playdemo, demo_gototick,
+    demo_timescale, disconnect and quit. With demo_debug 1 every tick played is
+    written to the console log as dem_usercmd lines, like the game does.
+
+    Frames are "rendered" on the main thread: each one burns cpu_share of its
+    frametime and sleeps the rest, and is logged by MangoHud when it is logging.
+    Frametimes follow emu_frametime, the workload of the tick being played and
+    fps_max. Loading reads at load_rate for load_time, so the load detector sees a
+    load. emu_crash is the chance that a playdemo crashes the game at some point
+    during the following playback
+    """
+
+    defaults = {
+        "demo_debug": "0",
+        "demo_timescale": "1",
+        "fps_max": "300",
+        "host_framerate": "0",
+        "con_logfile": "",
+        "hostport": "27015",
+        "ip": "localhost",
+        "rcon_password": "",
+        "sv_rcon_whitelist_address": "",
+        "emu_frametime": "6",
+        "emu_crash": "0",
+    }
+
+    # demo_gototick fast forwards at the first rate, doubling every second up to the
+    # second one. It notices it reached the tick a bit late, more so the faster it
+    # goes
+    gototick_rate = (300, 6000)
+    gototick_lag = 0.02
+
+    load_time = 1.5
+    load_rate = 256 * 1024 * 1024
+    cpu_share = 0.15
+    play_interval = 0.005
+
+    def __init__(self, game_path, argv):
+        self.game_path = Path(game_path)
+        self.cvars = dict(Emulator.defaults)
+        self.lock = threading.RLock()
+        self.quitting = threading.Event()
+        self.log = None
+        self.rcon = None
+        self.mangohud = None
+
+        self.demo = None
+        self.tick = 0.0
+        self.playing = False
+        self.loading = threading.Event()
+        self.goto = None
+        self.crash_at = None
+
+        commands, options = Emulator.parse_launch_options(argv)
+        game = options.get("game")
+        if game:
+            self.mod_path = self.game_path.parent / game
+        else:
+            gameinfo = tuple(self.game_path.parent.glob("./*/gameinfo.txt"))
+            if not gameinfo:
+                raise FileNotFoundError(f"No gameinfo.txt next to {self.game_path}")
+            self.mod_path = gameinfo[0].parent
+
+        for command in commands:
+            self.run(command)
+        if "condebug" in options and not self.cvars["con_logfile"]:
+            self.cvars["con_logfile"] = "console.log"
+        if self.cvars["con_logfile"]:
+            self.log = open(
+                self.mod_path / self.cvars["con_logfile"],
+                "w" if "conclearlog" in options else "a",
+                encoding="utf-8",
+            )
+
+        if os.environ.get("MANGOHUD_CONFIGFILE"):
+            self.mangohud = MangoHud(
+                os.environ["MANGOHUD_CONFIGFILE"], self.game_path.stem
+            )
+            self.mangohud.serve()
+
+    def main(self):
+        """Load, start answering rcon and render frames until quit"""
+        self._write("Emulated game starting\n")
+        self._load()
+        self.serve()
+        try:
+            self._render()
+        finally:
+            self.close()
+
+    def serve(self):
+        """Answer rcon and play demos, without rendering frames"""
+        if self.cvars["rcon_password"]:
+            self.rcon = RconServer(
+                self.run, int(self.cvars["hostport"]), self.cvars["rcon_password"]
+            ).start()
+        threading.Thread(target=self._play, daemon=True).start()
+
+    def close(self):
+        self.quitting.set()
+        if self.mangohud is not None:
+            self.mangohud.stop()
+        if self.rcon is not None:
+            self.rcon.close()
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    def run(self, text):
+        """Run console input and return its output"""
+        output = []
+        with self.lock:
+            for statement in split_commands(text):
+                try:
+                    words = shlex.split(statement)
+                except ValueError:
+                    words = statement.split()
+                if not words:
+                    continue
+                name = words[0].lower()
+                handler = getattr(self, "_cmd_" + name, None)
+                if handler is not None:
+                    output.append(handler(*words[1:]))
+                elif len(words) > 1:
+                    self.cvars[name] = words[1]
+                elif name in self.cvars:
+                    output.append(
+                        f'"{name}" = "{self.cvars[name]}"'
+                        f' ( def. "{Emulator.defaults.get(name, "")}" )\n'
+                    )
+                else:
+                    output.append(f'Unknown command "{name}"\n')
+            output = "".join(output)
+            self._write(output)
+        return output
+
+    def _cmd_echo(self, *words):
+        return " ".join(words) + "\n"
+
+    def _cmd_alias(self, *words):
+        return ""
+
+    def _cmd_net_start(self, *words):
+        return ""
+
+    def _cmd_exec(self, name="", *words):
+        cfg = self.mod_path / "cfg" / name
+        if cfg.suffix != ".cfg":
+            cfg = cfg.with_name(cfg.name + ".cfg")
+        try:
+            with open(cfg, encoding="utf-8") as f:
+                return self.run(f.read())
+        except OSError:
+            return f"exec: couldn't exec {name}\n"
+
+    def _cmd_playdemo(self, name="", *words):
+        path = find_demo_file(self.game_path, name)
+        if path is None:
+            return f"CDemoFile::Open: couldn't open file {name}.\n"
+        self.demo = read_header(path)
+        self.tick = 0.0
+        self.goto = None
+        self.playing = True
+        self.loading.set()
+        self.crash_at = None
+        if random.random() < float(self.cvars["emu_crash"]):
+            self.crash_at = random.uniform(0, self.demo.ticks)
+        return f"Playing demo from {path.name}.\n"
+
+    def _cmd_demo_gototick(self, tick="0", *words):
+        if not self.playing:
+            return "Not playing a demo.\n"
+        tick = int(tick) + (int(self.tick) if words[:1] == ("1",) else 0)
+        if tick <= self.tick:
+            self.tick = float(tick)
+        else:
+            self.goto = (tick, perf_counter())
+        return ""
+
+    def _cmd_demo_pause(self, *words):
+        self.cvars["emu_paused"] = "1"
+        return "Demo playback paused\n"
+
+    def _cmd_demo_resume(self, *words):
+        self.cvars["emu_paused"] = "0"
+        return "Demo playback resumed\n"
+
+    def _cmd_disconnect(self, *words):
+        self.playing = False
+        self.goto = None
+        return ""
+
+    def _cmd_quit(self, *words):
+        self.quitting.set()
+        return ""
+
+    _cmd_exit = _cmd_quit
+
+    def _write(self, text):
+        if text and self.log is not None:
+            self.log.write(text)
+            self.log.flush()
+
+    def _load(self):
+        """Read at load_rate for load_time seconds, like a map load does"""
+        deadline = perf_counter() + self.load_time
+        with open("/dev/zero", "rb", buffering=0) as f:
+            while perf_counter() < deadline and not self.quitting.is_set():
+                read = 0
+                while read < self.load_rate * 0.05:
+                    read += len(f.read(1024 * 1024))
+                sleep(0.05)
+
+    def _play(self):
+        """Advance the demo being played and log its ticks"""
+        last = perf_counter()
+        while not self.quitting.wait(self.play_interval):
+            if self.loading.is_set():
+                self._load()
+                self.loading.clear()
+                last = perf_counter()
+                continue
+            now = perf_counter()
+            elapsed, last = now - last, now
+            with self.lock:
+                if not self.playing or self.cvars.get("emu_paused") == "1":
+                    continue
+                interval = self.demo.tick_interval or 0.015
+                start = self.tick
+                if self.goto is not None:
+                    target, since = self.goto
+                    low, high = self.gototick_rate
+                    rate = min(low * 2 ** (now - since), high)
+                    self.tick += rate * elapsed
+                    if self.tick >= target:
+                        self.tick = target + int(
+                            rate * random.uniform(0, 1) * self.gototick_lag
+                        )
+                        self.goto = None
+                else:
+                    self.tick += (
+                        float(self.cvars["demo_timescale"]) * elapsed / interval
+                    )
+
+                lines = []
+                if self.cvars["demo_debug"] != "0":
+                    for tick in range(
+                        int(start) + 1, min(int(self.tick), self.demo.ticks) + 1
+                    ):
+                        lines.append(f"{tick} dem_packet\n{tick} dem_usercmd\n")
+                if self.tick >= self.demo.ticks:
+                    self.playing = False
+                    if self.cvars["demo_debug"] != "0":
+                        lines.append("dem_stop\n")
+                self._write("".join(lines))
+                if self.crash_at is not None and self.tick >= self.crash_at:
+                    logging.critical(f"Emulated crash at tick {int(self.tick)}")
+                    os.abort()
+
+    def _render(self):
+        while not self.quitting.is_set():
+            frametime = self._frametime()
+            start = perf_counter()
+            busy = start + frametime * self.cpu_share / 1000
+            while perf_counter() < busy:
+                pass
+            self.quitting.wait(max(start + frametime / 1000 - perf_counter(), 0))
+            if self.mangohud is not None:
+                self.mangohud.frame(frametime)
+
+    def _frametime(self):
+        """Milliseconds the next frame takes"""
+        if self.loading.is_set():
+            return 50.0
+        base = float(self.cvars["emu_frametime"])
+        load = workload(self.tick) if self.playing else 0.6
+        frametime = base * load * random.lognormvariate(0, 0.08)
+        fps_max = float(self.cvars["fps_max"])
+        if fps_max > 0:
+            frametime = max(frametime, 1000 / fps_max)
+        return frametime
+
+    @staticmethod
+    def parse_launch_options(argv):
+        """
+        Split launch options into console commands (+command args) and options
+        (-option [value])
+        """
+        commands = []
+        options = {}
+        current = None
+        for word in argv:
+            if word.startswith("+"):
+                current = [word[1:]]
+                commands.append(current)
+            elif word.startswith("-") and not word[1:2].isdigit():
+                current = None
+                option = word[1:]
+                options[option] = True
+            elif current is not None:
+                current.append(word)
+            elif options:
+                options[option] = word
+        return [" ".join(shlex.quote(w) for w in c) for c in commands], options
+
+
+def write_demo(path, ticks=20000, tick_interval=0.015):
+    """
+    Write a demo with a packet per tick, each one updating as many entities as the
+    workload of the tick says, that demoknight.demo can read
+    """
+    frames = []
+    for tick in range(1, ticks + 1):
+        # svc_PacketEntities: type, max entries, not a delta, baseline, updated
+        # entries, length of the (empty) entity data, update baseline
+        entities = round(64 * workload(tick))
+        bits = 26 | (entities << 19)
+        message = bits.to_bytes(7, "little")
+        frames.append(
+            struct.pack("<Bi", DEM_PACKET, tick)
+            + bytes(76 + 8)
+            + struct.pack("<i", len(message))
+            + message
+        )
+    frames.append(struct.pack("<Bi", DEM_STOP, ticks))
+    header = HEADER.pack(
+        MAGIC,
+        3,
+        24,
+        b"emulator",
+        b"demoknight",
+        b"emulator",
+        b"tf",
+        ticks * tick_interval,
+        ticks,
+        ticks,
+        0,
+    )
+    with open(path, "wb") as f:
+        f.write(header + b"".join(frames))
+
+
+def build_tree(root, ticks=20000, tick_interval=0.015, python=None):
+    """
+    Lay out an emulated game under root, returning the path of its launcher:
+
+    - hl2.sh, launcher that runs the emulator under its own name, so it is found
+      like the game would be
+    - tf/gameinfo.txt, with the write paths and app id of Team Fortress 2
+    - tf/demos/emulator.dem, from write_demo
+    - bin/mangohud, which only runs the command it is given
+    - home/.steam/steam, an empty Steam directory for machines without Steam
+    """
+    root = Path(root).absolute()
+    mod = root / "tf"
+    (mod / "demos").mkdir(parents=True, exist_ok=True)
+    (mod / "cfg").mkdir(exist_ok=True)
+    (root / "bin").mkdir(exist_ok=True)
+    (root / "home" / ".steam" / "steam").mkdir(parents=True, exist_ok=True)
+
+    with open(mod / "gameinfo.txt", "w", encoding="utf-8") as f:
+        f.write(
+            '"GameInfo"\n{\n\tgame\t"Emulator"\n\t"FileSystem"\n\t{\n'
+            '\t\tSteamAppId\t\t\t\t440\n\t\t"SearchPaths"\n\t\t{\n'
+            '\t\t\t"mod+mod_write+default_write_path"\t\t"tf"\n'
+            '\t\t\t"game"\t\t\t\t"tf"\n\t\t}\n\t}\n}\n'
+        )
+    write_demo(mod / "demos" / "emulator.dem", ticks, tick_interval)
+
+    # Python finds its libraries from the name it is run as, which is the game's
+    # here, so they are passed along in PYTHONPATH
+    paths = [str(Path(__file__).parent.parent)] + site.getsitepackages()
+    launcher = root / "hl2.sh"
+    with open(launcher, "w", encoding="utf-8") as f:
+        f.write(
+            "#!/usr/bin/env bash\n"
+            'self="$(cd "$(dirname "$0")" && pwd)/$(basename "$0")"\n'
+            f"export PYTHONPATH={shlex.quote(':'.join(paths))}"
+            "${PYTHONPATH:+:$PYTHONPATH}\n"
+            f'exec -a "$self" {shlex.quote(python or sys.executable)}'
+            ' -m demoknight.emulator game "$self" "$@"\n'
+        )
+    with open(root / "bin" / "mangohud", "w", encoding="utf-8") as f:
+        f.write('#!/bin/sh\nexec "$@"\n')
+    launcher.chmod(0o755)
+    (root / "bin" / "mangohud").chmod(0o755)
+    return launcher
+
+
+def cli(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m demoknight.emulator",
+        description="Headless stand-in for a Source game, to run demoknight against",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    tree = commands.add_parser("tree", help="Lay out an emulated game in a directory")
+    tree.add_argument("root", type=Path)
+    tree.add_argument(
+        "--ticks",
+        default=20000,
+        type=int,
+        help="Length of the demo. Default: %(default)s",
+    )
+    tree.add_argument(
+        "--tick-interval", default=0.015, type=float, help="Default: %(default)s"
+    )
+    game = commands.add_parser("game", help="Run the emulated game, used by hl2.sh")
+    game.add_argument("game_path", type=Path)
+    game.add_argument("launch_options", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.command == "tree":
+        launcher = build_tree(args.root, args.ticks, args.tick_interval)
+        root = launcher.parent
+        command = (
+            f"PATH={root / 'bin'}:$PATH demoknight -G {launcher} -D demos/emulator"
+        )
+        if not Path("~/.steam/steam").expanduser().exists():
+            command = f"HOME={root / 'home'} {command}"
+        print(command)
+    else:
+        logging.basicConfig(level=logging.INFO)
+        Emulator(args.game_path, args.launch_options).main()
+
+
+if __name__ == "__main__":
+    cli(sys.argv[1:])
@@ -0,0 +1,125 @@
+import json
+import logging
+import math
+from pathlib import Path
+from platform import node
+
+from platformdirs import user_cache_dir
+
+
+class FastForward:
+    """
+    Learns how a demo advances on this machine and plans the demo_gototick and
+    demo_timescale steps that get to a tick as fast as possible without going past it.
+
+    Three things are measured and kept per demo and machine:
+    - how far demo_gototick overshoots the requested tick (mean and deviation)
+    - how many ticks per second the demo advances at each timescale of `ladder`
+    - how long it takes for a tick to show up in the console log (lag)
+    """
+
+    # Kept across reboots, so the model doesn't start from scratch after every one
+    path = Path(user_cache_dir("demoknight", False)) / "fastforward.json"
+
+    # Timescales the approach can use, rates are learned for each of them
+    ladder = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 12)
+    final_timescale = 0.05
+
+    # Weight of a new observation in the moving averages
+    alpha = 0.3
+
+    # How many deviations of gototick overshoot and how many times the log lag to
+    # keep as margin
+    overshoot_deviations = 3
+    lag_safety = 2
+
+    def __init__(self, demo, tick_interval):
+        self.demo = (demo, tick_interval)
+        self.key = f"{node()}|{demo}"
+        self.tick_interval = tick_interval
+        self.model = {
+            # Until measured, assume gototick can overshoot by a couple of seconds
+            "overshoot": [0, 2 / tick_interval],
+            "lag": 0.3,
+            "rates": {},
+        }
+        try:
+            with open(FastForward.path, encoding="utf-8") as f:
+                self.model.update(json.load(f).get(self.key, {}))
+        except (OSError, ValueError):
+            pass
+
+    def rate(self, timescale):
+        """Ticks per second at timescale, the nominal rate until measured"""
+        return self.model["rates"].get(str(timescale), timescale / self.tick_interval)
+
+    def switch_margin(self, timescale):
+        """Ticks played at timescale between reaching a tick and reacting to it"""
+        return math.ceil(self.rate(timescale) * self.model["lag"] * self.lag_safety) + 1
+
+    def gototick_margin(self):
+        mean, dev = self.model["overshoot"]
+        return math.ceil(
+            max(mean, 0) + self.overshoot_deviations * dev + self.switch_margin(1)
+        )
+
+    def plan(self, current, target):
+        """
+        Return the (command, value, tick to wait for) steps that go from current to
+        target. The last step always slows down to final_timescale and waits for the
+        target itself
+        """
+        steps = []
+        jump = target - self.gototick_margin()
+        if jump - current > self.switch_margin(self.ladder[-1]):
+            steps.append(("demo_gototick", jump, jump))
+            current = jump
+
+        # Step down the ladder, always taking the fastest timescale that still leaves
+        # half of the remaining distance to react
+        slowing = True
+        while slowing:
+            slowing = False
+            for timescale in reversed(self.ladder):
+                if timescale <= self.final_timescale:
+                    break
+                switch = target - self.switch_margin(timescale)
+                if switch > current and switch - current >= (target - current) / 2:
+                    steps.append(("demo_timescale", timescale, switch))
+                    current = switch
+                    slowing = True
+                    break
+
+        steps.append(("demo_timescale", self.final_timescale, target))
+        return steps
+
+    def observe(self, command, value, wait, start, reached, elapsed):
+        """
+        Update the model with the outcome of one step: the tick it started from, the
+        tick it was waiting for, the first tick seen at or past it and the wall time
+        the step took
+        """
+        if command == "demo_gototick":
+            mean, dev = self.model["overshoot"]
+            overshoot = reached - value
+            mean += self.alpha * (overshoot - mean)
+            dev += self.alpha * (abs(overshoot - mean) - dev)
+            self.model["overshoot"] = [mean, dev]
+        elif elapsed > 0 and reached > start:
+            rate = self.rate(value)
+            rate += self.alpha * ((reached - start) / elapsed - rate)
+            self.model["rates"][str(value)] = rate
+            lag = (reached - wait) / rate
+            self.model["lag"] += self.alpha * (max(lag, 0) - self.model["lag"])
+        logging.debug(f"Fast-forward model for {self.key}: {self.model}")
+
+    def save(self):
+        try:
+            with open(FastForward.path, encoding="utf-8") as f:
+                models = json.load(f)
+        except (OSError, ValueError):
+            models = {}
+        models[self.key] = self.model
+        FastForward.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(FastForward.path, "w", encoding="utf-8") as f:
+            json.dump(models, f, indent=1)
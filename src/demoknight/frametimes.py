@@ -0,0 +1,336 @@
+import bisect
+import json
+import math
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import cpu_count, replace
+from pathlib import Path
+
+import numpy as np
+
+# Columns of each capture format: frametime (ms), elapsed time, header rows to skip
+# and elapsed time units per second
+FORMATS = {
+    "mangohud": {"usecols": (1, 13), "skiprows": 3, "one_second": 1000000000},
+    "presentmon": {"usecols": (9, 7), "skiprows": 1, "one_second": 1},
+}
+# Columns of the cache written after every pass, in the order load returns them
+COLUMNS = ("frametime", "elapsed")
+
+
+def capture_format(path):
+    return "presentmon" if Path(path).name.startswith("PresentMon") else "mangohud"
+
+
+def load(path, start_buffer=0):
+    """
+    Frametimes and elapsed seconds of a capture file, as two columns without the
+    first start_buffer seconds. Elapsed time still counts from the start of the
+    capture. From its column cache when there is one, as the float32 memory maps
+    of load_columns, so nothing is read or copied until used
+    """
+    columns = load_columns(path, start_buffer)
+    if columns is not None:
+        return columns
+    arr = _parse(path)
+    start = np.searchsorted(arr[:, 1], start_buffer)
+    return arr[start:, 0], arr[start:, 1]
+
+
+def _parse(path, start_buffer=0):
+    fmt = FORMATS[capture_format(path)]
+    arr = np.loadtxt(
+        Path(path),
+        delimiter=",",
+        usecols=fmt["usecols"],
+        skiprows=fmt["skiprows"],
+        ndmin=2,
+    )
+    arr[:, 1] = arr[:, 1] / fmt["one_second"] - start_buffer
+    return arr[arr[:, 1] >= 0]
+
+
+def column_paths(path):
+    """Where the column cache of a capture file goes, one .npy per column"""
+    path = Path(path)
+    return {c: path.with_name(f"{path.stem}.{c}.npy") for c in COLUMNS}
+
+
+def write_columns(path):
+    """
+    Convert a capture file to its column cache: frametimes in ms and elapsed time
+    in seconds, as float32
+    """
+    arr = _parse(path)
+    paths = column_paths(path)
+    for i, column in enumerate(COLUMNS):
+        # Through a temporary file, so a cache is never seen half written
+        temp = paths[column].with_suffix(".tmp")
+        with open(temp, "wb") as f:
+            np.save(f, arr[:, i].astype(np.float32))
+        replace(temp, paths[column])
+    return paths
+
+
+def load_columns(path, start_buffer=0):
+    """
+    Frametimes and elapsed seconds of a capture file from its column cache, as
+    read-only memory maps without the first start_buffer seconds. None if there is
+    no cache or it is older than the file
+    """
+    paths = column_paths(path)
+    try:
+        mtime = Path(path).stat().st_mtime if Path(path).exists() else 0
+        if any(p.stat().st_mtime < mtime for p in paths.values()):
+            return None
+        frametime, elapsed = (np.load(paths[c], mmap_mode="r") for c in COLUMNS)
+    except FileNotFoundError:
+        return None
+    # Elapsed time only goes up, so trimming is a slice and nothing gets read
+    start = np.searchsorted(elapsed, start_buffer)
+    return frametime[start:], elapsed[start:]
+
+
+def record_pass(manifest, test, loop, number, path):
+    """
+    Add a pass to the manifest of a job's column caches, keyed by test, loop and
+    pass number within the loop
+    """
+    manifest = Path(manifest)
+    try:
+        with open(manifest, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {"columns": list(COLUMNS), "tests": {}}
+    passes = data["tests"].setdefault(test, {}).setdefault(str(loop), {})
+    passes[str(number)] = {
+        "capture": str(path),
+        **{c: str(p) for c, p in column_paths(path).items()},
+    }
+    temp = manifest.with_suffix(".tmp")
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+    replace(temp, manifest)
+
+
+def load_results(file, workers=None):
+    """
+    Every capture of an output file, as {test name: [frametime and elapsed columns
+    from load per pass, in the order of results]}. Captures with a column cache are
+    mapped straight away. Parsing text is CPU bound, so the rest are spread over a pool of
+    processes, one per core unless workers says otherwise
+    """
+    paths = [res for test in file["tests"] for res in test["results"]]
+    loaded = {}
+    for path in paths:
+        columns = load_columns(path, file["start_buffer"])
+        if columns is not None:
+            loaded[path] = columns
+    missing = [path for path in paths if path not in loaded]
+    if missing:
+        workers = workers or cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool:
+            loaded.update(
+                zip(
+                    missing,
+                    pool.map(
+                        partial(load, start_buffer=file["start_buffer"]),
+                        missing,
+                        chunksize=max(1, len(missing) // (workers * 4)),
+                    ),
+                )
+            )
+    arrays = iter(loaded[path] for path in paths)
+    return {
+        test["name"]: [next(arrays) for _ in test["results"]] for test in file["tests"]
+    }
+
+
+class P2Quantile:
+    """
+    Running estimate of a quantile in constant memory, with the P-square algorithm
+    of Jain and Chlamtac: five markers whose heights are adjusted with a parabolic
+    fit as observations come in
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        heights = self.heights
+        if len(heights) < 5:
+            bisect.insort(heights, x)
+            return
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(heights, x) - 1
+        for i in range(k + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - self.positions[i]
+            if (d >= 1 and self.positions[i + 1] - self.positions[i] > 1) or (
+                d <= -1 and self.positions[i - 1] - self.positions[i] < -1
+            ):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, d)
+                heights[i] = height
+                self.positions[i] += d
+
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[
+                min(int(self.p * len(self.heights)), len(self.heights) - 1)
+            ]
+        return self.heights[2]
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+
+class StreamingStats:
+    """
+    Count, mean and variance (Welford), extremes and the 99th and 99.9th percentile
+    frametimes (the 1% and 0.1% lows), updated one frame at a time
+    """
+
+    quantiles = {"p99": 0.99, "p99_9": 0.999}
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._quantiles = {k: P2Quantile(p) for k, p in self.quantiles.items()}
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        for quantile in self._quantiles.values():
+            quantile.add(x)
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "stdev": math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0,
+            "min": self.min,
+            "max": self.max,
+            **{k: q.value() for k, q in self._quantiles.items()},
+        }
+
+
+class CaptureTailer(threading.Thread):
+    """
+    Follows the capture file of a pass while it is being written, feeding every
+    frame past the start buffer to a StreamingStats. The file is found as the newest
+    capture in folder that isn't in existing. A frame longer than max_frametime
+    means the game hung or loaded something mid-capture, and marks the pass broken.
+    With a max_frametime of 0 no pass is ever broken
+    """
+
+    interval = 0.5
+
+    def __init__(self, folder, existing, start_buffer=0, max_frametime=1000):
+        super().__init__(daemon=True)
+        self.folder = folder
+        self.existing = existing
+        self.start_buffer = start_buffer
+        self.max_frametime = max_frametime
+        self.stats = StreamingStats()
+        self.path = None
+        self.broken = threading.Event()
+        self.reason = None
+        self._finished = threading.Event()
+        self._position = 0
+        self._partial = b""
+        self._line = 0
+
+    def run(self):
+        while not self._finished.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        """Stop following and read whatever is left of the file"""
+        self._finished.set()
+        if self.is_alive():
+            self.join()
+        self.poll()
+        return self.stats.summary()
+
+    def poll(self):
+        if self.path is None:
+            found = [
+                log
+                for log in self.folder.glob("./*[0-9].csv")
+                if log not in self.existing
+            ]
+            if not found:
+                return
+            self.path = max(found, key=lambda x: x.stat().st_mtime)
+            self.format = FORMATS[capture_format(self.path)]
+
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._position)
+                data = self._partial + f.read()
+        except FileNotFoundError:
+            # Moved away by the pass, it was read to the end before that
+            return
+        self._position += len(data) - len(self._partial)
+        cut = data.rfind(b"\n") + 1
+        self._partial = data[cut:]
+
+        frametime_col, elapsed_col = self.format["usecols"]
+        for line in data[:cut].splitlines():
+            self._line += 1
+            if self._line <= self.format["skiprows"]:
+                continue
+            fields = line.split(b",")
+            try:
+                frametime = float(fields[frametime_col])
+                elapsed = float(fields[elapsed_col]) / self.format["one_second"]
+            except (IndexError, ValueError):
+                continue
+            if elapsed < self.start_buffer:
+                continue
+            self.stats.add(frametime)
+            if (
+                self.max_frametime
+                and frametime > self.max_frametime
+                and not self.broken.is_set()
+            ):
+                self.reason = f"{frametime:.0f}ms frame at {elapsed:.1f}s"
+                self.broken.set()
@@ -6,20 +6,25 @@ import re
 import socket
 import string
 import threading
+import zlib
 from pathlib import Path
 from enum import Enum
 from platform import system
 from random import SystemRandom, randint
-from time import sleep, time
+from time import perf_counter, sleep, time
 
 import psutil
 
 # TODO: Undo monkey patch when pull request is merged: https://github.com/ValvePython/vdf/pull/53
 from . import vdf_patch
 import vdf
-from rcon.exceptions import EmptyResponse
+from rcon.exceptions import EmptyResponse, SessionTimeout
 from rcon.source import Client
-from watchfiles import watch
+
+from .fastforward import FastForward
+from .log_tailer import LogTailer
+from .processes import ProcessIndex
+from .watchdog import ExitWatcher, LoadDetector, WakingEvent
 
 
 class GameState(Enum):
@@ -36,131 +41,76 @@ class Game(psutil.Popen):
     rudimentary way.
     """
 
-    def __init__(
-        self, gameid=0, game_path=None, steam_path=None, l_opts=tuple(), **kwargs
-    ):
-        self.password = l_opts[l_opts.index("+rcon_password") + 1]
-        self.port = int(l_opts[l_opts.index("+hostport") + 1])
-        self.quitted = 0
-        self.last_position = 0
-        self.state = mp.Value("i", GameState.DEFAULT.value)
-        self.not_capturing = threading.Event()
-        self.not_capturing.set()
+    # Seconds without any rcon traffic after which the watchdog pings the game to keep
+    # the connection from going stale
+    rcon_keepalive = 30
 
-        if gameid:
-            if system().startswith("Win"):
-                try:
-                    steam_bin = steam_path / "steam.exe"
-                except TypeError as e:
-                    raise Exception("On Windows you need to specify steam_path") from e
-            elif system().startswith("Linux"):
-                steam_bin = "steam"
+    # The console splits rcon input into lines of at most 512 characters, well under
+    # the 4096 byte rcon packet limit, so batches have to fit the smaller of the two
+    rcon_batch_limit = 500
 
-            args = (str(steam_bin), "-applaunch", str(gameid)) + l_opts
+    # Shared by every instance, so each lookup only inspects processes started
+    # since the last one
+    processes = ProcessIndex()
 
-        else:
-            args = ("mangohud", game_path) + l_opts
+    # Seconds between watchdog samples in each state. Nothing is sampled while
+    # capturing, exit is noticed without sampling either way
+    watchdog_interval = {
+        GameState.DEFAULT: 0.1,
+        GameState.LOADING: 0.1,
+        GameState.RUNNING: 1,
+    }
 
-        # Check if steam is setup correctly, only start job if it is not running or
-        # if it has the correct mangohud config already
-        if gameid:
-            logging.info("Checking if steam has the right enviroment variables set")
-            steam_state = Game._steam_state(**kwargs)
-            logging.debug(f"Steam State: {steam_state.value}")
+    # Seconds the game has to finish loading a map, or launching, before it is
+    # considered stuck
+    load_timeout = 600
 
-            if steam_state in (SteamState.NOT_STARTED, SteamState.CONFIGURED):
-                print("Starting game")
-                print("The game must be in focus to be benchmarked properly")
-            elif steam_state == SteamState.NO_MANGOHUD:
-                raise OSError(
-                    "Steam is running but does not have the right GAME_DEBUGGER, please"
-                    " close Steam so it can be opened with the correct launch options"
-                )
-
-            # Due to a vulnerability related to using the steam protocol through a
-            # browser, steam has disabled the ability to use %command% in launch
-            # options using the 'steam' command
+    def __init__(
+        self, gameid=0, game_path=None, steam_path=None, l_opts=tuple(), **kwargs
+    ):
+        self._setup(
+            l_opts[l_opts.index("+rcon_password") + 1],
+            int(l_opts[l_opts.index("+hostport") + 1]),
+            GameState.DEFAULT,
+        )
 
-            # So to launch the game with mangohud, it's easier if we just launch
-            # steam with GAME_DEBUGGER set. Another option would be to append the
-            # vtf file that handles launch options inside ~/.steam.
-            elif steam_state == SteamState.NOT_CONFIGURED:
-                raise OSError(
-                    "Steam is running but does not have the right MANGOHUD_CONFIG,"
-                    " please close Steam so it can be opened with the correct launch"
-                    " options"
-                )
-            else:
-                raise OSError("unknown steam_state")
+        args = Game._launch_args(gameid, game_path, steam_path, l_opts, **kwargs)
 
         # TODO: Handle ProcessAlreadyRunning
         if Game._find_game_proc(game_path):
             raise Exception("Game is already running, close it and try again")
 
-        gameinfo_path = tuple(game_path.parent.glob("./*/gameinfo.txt"))[0]
-
-        # Find log locations
-        gameinfo = vdf.load(open(gameinfo_path), mapper=vdf.VDFDict)
-        write_paths = []
-        for k, v in gameinfo["GameInfo"]["FileSystem"]["SearchPaths"].iteritems():
-            if v.startswith("|all_source_engine_paths|"):
-                v = game_path.parent.absolute() / Path(
-                    v.replace("|all_source_engine_paths|", "")
-                )
-            elif v.startswith("|gameinfo_path|"):
-                v = game_path.parent.absolute() / Path(v.replace("|gameinfo_path|", ""))
-            else:
-                v = game_path.parent.absolute() / Path(v)
-            if any(
-                i in k.split("+")
-                for i in ("default_write_path", "game_write", "mod_write")
-            ):
-                if v not in write_paths:
-                    write_paths.append(Path(v))
-
-        logs = [file for path in write_paths for file in path.glob("./demoknight.log")]
-
-        # Clear log file before each run given we are spamming it so much
-        if len(logs) > 1:
-            raise FileNotFoundError("More than one demoknight.log file was found")
-        elif logs:
-            self.log_path = logs[0]
-            try:
-                logging.info(f"Removing {self.log_path}")
-                os.remove(self.log_path)
-            except FileNotFoundError:
-                logging.info(f"{self.log_path} doesn't exists, continuig.")
-        else:
-            self.log_path = None
+        write_paths = Game._write_paths(game_path)
+        self.log_path = Game._clear_log(write_paths)
 
         super().__init__(args, **kwargs)
 
-        pid = None
-        timeout = 0
-        while timeout < 60:
-            logging.debug("Waiting for game process to launch")
-            pid = Game._find_game_proc(game_path)
-            if pid is None:
-                sleep(1)
-                timeout += 1
-            else:
+        # The game is usually a descendant of the launcher, unless Steam was
+        # already running and took over the launch
+        deadline = time() + 60
+        while True:
+            pid = Game._find_game_proc(game_path, root=self.pid)
+            if pid is not None:
                 break
-        else:
-            raise TimeoutError("Could not find game process after 60 seconds")
+            if time() > deadline:
+                raise TimeoutError("Could not find game process after 60 seconds")
+            logging.debug("Waiting for game process to launch")
+            sleep(0.2)
 
         # Trick psutil into tracking the game instead of the "steam -applaunch" process
         self._init(pid, _ignore_nsp=True)
 
-        self.watchdog_exceptions = queue.Queue()
-
+        self.exit_watcher = ExitWatcher(pid)
+        self.not_capturing.watcher = self.exit_watcher
         self.watchdog = threading.Thread(target=self.update_state, daemon=True)
         self.watchdog.start()
 
         # Wait for the game to finish loading
-        while not self.state.value == GameState.RUNNING.value:
-            if not self.watchdog_exceptions.empty():
-                raise self.watchdog_exceptions.get()
-            sleep(1)
+        try:
+            self._wait_for_state(GameState.RUNNING, Game.load_timeout)
+        except TimeoutError:
+            self.kill()
+            raise
 
         # Get log if I don't have it already
         while not self.log_path:
@@ -176,93 +126,222 @@ class Game(psutil.Popen):
             except IndexError:
                 pass
 
+        self.log = LogTailer(self.log_path)
+
+    @classmethod
+    def attach(cls, port, password, log_path):
+        """
+        A Game for a game that is already running, to drive it through rcon and its
+        console log without launching it. Its process isn't watched, it is always
+        taken to be running
+        """
+        game = cls.__new__(cls)
+        game._setup(password, port, GameState.RUNNING)
+        game.log_path = Path(log_path)
+        game.log = LogTailer(game.log_path)
+        return game
+
+    def _setup(self, password, port, state):
+        self.password = password
+        self.port = port
+        self.quitted = 0
+        self.state = mp.Value("i", state.value)
+        # (time, state) for every transition, and a condition to wait for them
+        self.state_history = [(time(), state)]
+        self.state_changed = threading.Condition()
+        self.not_capturing = WakingEvent()
+        self.not_capturing.set()
+        self.watchdog_exceptions = queue.Queue()
+
+        # A single authenticated rcon connection is kept for the whole session. The
+        # lock serializes the main thread and the watchdog keep-alive
+        self._rcon_client = None
+        self._rcon_lock = threading.Lock()
+        self.rcon_last_used = 0
+        self.rcon_stats = {}
+        self.generated_cfgs = set()
+        self.demo = None
+        self.fastforward = None
+
     def update_state(self):
-        last_not_running = 0
-        last_disk_sleep = time()
-        while not self.state.value == GameState.NOT_RUNNING.value:
-            sleep(0.5)
-            # Turn off watchdog while capturing data to reduce influences
-            self.not_capturing.wait()
-
-            if self.is_running():
-                last_not_running = 0
-                logging.debug(f"Process Status: {self.status()}")
-
-                # Zombie
-                if self.quitted:
-                    if time() - self.quitted > 10:
-                        logging.warning(
-                            "Game took too long to quit, killing process now."
-                        )
-                        self.kill()
-
-                # Loading
-                if self.status() in (psutil.STATUS_DISK_SLEEP, psutil.STATUS_SLEEPING):
-                    last_disk_sleep = time()
-                    self.state.value = GameState.LOADING.value
-                    continue
-                if time() - last_disk_sleep < 5:
-                    self.state.value = GameState.LOADING.value
-                    continue
+        loads = LoadDetector(self.pid)
+        while True:
+            if not self.not_capturing.is_set():
+                # Turn off sampling while capturing data to reduce influences, only a
+                # crash or the end of the capture wake the watchdog up
+                if self.exit_watcher.wait(None):
+                    break
+                continue
+
+            interval = Game.watchdog_interval[GameState(self.state.value)]
+            if self.exit_watcher.wait(interval):
+                break
 
-                # Running
-                self.state.value = GameState.RUNNING.value
+            # Zombie
+            if self.quitted and time() - self.quitted > 10:
+                logging.warning("Game took too long to quit, killing process now.")
+                self.kill()
+
+            try:
+                if self.status() == psutil.STATUS_ZOMBIE:
+                    break
+                loading = loads.update(perf_counter())
+            except psutil.NoSuchProcess:
+                break
+            logging.debug(f"Process rates: {loads.rates}")
+
+            if loading:
+                self._set_state(GameState.LOADING)
             else:
-                # Not running
-                last_not_running = last_not_running or time()
-                if last_not_running and (time() - last_not_running > 5):
-                    self.state.value = GameState.NOT_RUNNING.value
-                    continue
+                self._set_state(GameState.RUNNING)
+                if not self.quitted:
+                    self._rcon_keepalive()
 
             # TODO: Include other states like fastfowarding and Unresponsive
-        else:
-            if not self.quitted:
-                self.watchdog_exceptions.put(psutil.NoSuchProcess(self.pid))
+
+        # Not running
+        self.exit_watcher.close()
+        if not self.quitted:
+            self.watchdog_exceptions.put(psutil.NoSuchProcess(self.pid))
+        self._set_state(GameState.NOT_RUNNING)
+
+    def _set_state(self, state):
+        if state.value == self.state.value:
+            return
+        with self.state_changed:
+            self.state.value = state.value
+            self.state_history.append((time(), state))
+            self.state_changed.notify_all()
+        logging.info(f"Game state: {state.name}")
+
+    def _wait_for_state(self, state, timeout):
+        """
+        Wait up to timeout seconds for the watchdog to report state, or raise what
+        made it stop
+        """
+        with self.state_changed:
+            reached = self.state_changed.wait_for(
+                lambda: self.state.value in (state.value, GameState.NOT_RUNNING.value),
+                timeout,
+            )
+        if not reached:
+            raise TimeoutError(f"Game not {state.name} after {timeout} seconds")
+        if not self.watchdog_exceptions.empty():
+            raise self.watchdog_exceptions.get()
 
     def rcon(self, command: str):
         if not self.watchdog_exceptions.empty():
             raise self.watchdog_exceptions.get()
         response = ""
         logging.info(f"Issued rcon command: {command}")
-        while True:
-            try:
-                with Client(
-                    "127.0.0.1",
-                    self.port,
-                    passwd=self.password,
-                    # extremely long timeout because demo_timescale messes
-                    # with response time
-                    timeout=5,
-                ) as client:
+        with self._rcon_lock:
+            while True:
+                try:
+                    client = self._rcon_client or self._rcon_connect()
+                    tic = perf_counter()
                     response = client.run(command)
-            except TimeoutError:
-                logging.info("Rcon command timed out, retrying in 1 second.")
-                sleep(1)
-                continue
-            except ConnectionRefusedError:
-                # This usually means the game has not finished starting yet, or that it
-                # crashed.
-                if not self.watchdog_exceptions.empty():
-                    raise self.watchdog_exceptions.get()
-                logging.info("Rcon connection refused, retrying in 1 second")
-                sleep(1)
-                continue
-            except (ConnectionResetError, ConnectionAbortedError):
-                logging.info("Rcon connection reset, retrying in 1 second")
-                sleep(1)
-                continue
-            except EmptyResponse:
-                # Empty responses usually mean the game is currently at a loading screen
-                # loading screens are tracked by self.watchdog so this should never
-                # happen.
-                logging.info("Game sent empty response, aborting test and restarting")
-                sleep(1)
-                continue
-            # Not every command sends a response, so i have to assume its a success
-            # if there is no connection or timeout error
-            break
+                    self._rcon_account(command, perf_counter() - tic)
+                except TimeoutError:
+                    self._rcon_disconnect()
+                    if self.quitted:
+                        break
+                    logging.info("Rcon command timed out, retrying in 1 second.")
+                    sleep(1)
+                    continue
+                except ConnectionRefusedError:
+                    self._rcon_disconnect()
+                    if self.quitted:
+                        break
+                    # This usually means the game has not finished starting yet, or
+                    # that it crashed.
+                    if not self.watchdog_exceptions.empty():
+                        raise self.watchdog_exceptions.get()
+                    logging.info("Rcon connection refused, retrying in 1 second")
+                    sleep(1)
+                    continue
+                except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                    self._rcon_disconnect()
+                    if self.quitted:
+                        break
+                    logging.info("Rcon connection reset, reconnecting in 1 second")
+                    sleep(1)
+                    continue
+                except SessionTimeout:
+                    # A response to an earlier command that timed out arrived late, the
+                    # stream is out of sync so start over with a fresh connection
+                    self._rcon_disconnect()
+                    logging.info("Rcon response out of order, reconnecting")
+                    continue
+                except EmptyResponse:
+                    # Empty responses usually mean the game is currently at a loading
+                    # screen loading screens are tracked by self.watchdog so this should
+                    # never happen.
+                    self._rcon_disconnect()
+                    if self.quitted:
+                        break
+                    logging.info("Game sent empty response, reconnecting in 1 second")
+                    sleep(1)
+                    continue
+                # Not every command sends a response, so i have to assume its a success
+                # if there is no connection or timeout error
+                break
         return response
 
+    def _rcon_connect(self):
+        client = Client(
+            "127.0.0.1",
+            self.port,
+            passwd=self.password,
+            # extremely long timeout because demo_timescale messes
+            # with response time
+            timeout=5,
+        )
+        try:
+            tic = perf_counter()
+            client.connect(login=True)
+        except BaseException:
+            client.close()
+            raise
+        logging.debug(f"Rcon connection established in {perf_counter() - tic:.4f}s")
+        self._rcon_client = client
+        return client
+
+    def _rcon_disconnect(self):
+        if self._rcon_client is not None:
+            self._rcon_client.close()
+            self._rcon_client = None
+
+    def _rcon_account(self, command, elapsed):
+        """Keep count, total, worst and last round-trip time for each command"""
+        self.rcon_last_used = time()
+        stats = self.rcon_stats.setdefault(
+            command.split(" ", 1)[0], {"count": 0, "total": 0.0, "max": 0.0}
+        )
+        stats["count"] += 1
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        stats["last"] = elapsed
+        logging.debug(f"Rcon response delay: {elapsed}")
+
+    def _rcon_keepalive(self):
+        # Never block the watchdog behind a command issued by the main thread, that
+        # command is traffic enough
+        if not self._rcon_lock.acquire(blocking=False):
+            return
+        try:
+            if self._rcon_client is None:
+                return
+            if time() - self.rcon_last_used < Game.rcon_keepalive:
+                return
+            tic = perf_counter()
+            self._rcon_client.run("echo")
+            self._rcon_account("echo", perf_counter() - tic)
+        except Exception as e:
+            logging.info(f"Rcon keep-alive failed, dropping connection: {e!r}")
+            self._rcon_disconnect()
+        finally:
+            self._rcon_lock.release()
+
     def playdemo(self, demo):
         if not self.watchdog_exceptions.empty():
             raise self.watchdog_exceptions.get()
@@ -271,14 +350,20 @@ class Game(psutil.Popen):
         exception is raised
         """
         self.rcon("demo_debug 1")
+        # Ticks left over from the last playback don't count
+        self.log.reset()
+        self.demo = demo
         res = self.rcon(f"playdemo {demo}")
         if res.startswith("CDemoFile::Open: couldn't open file "):
             raise FileNotFoundError(
                 f"Demo file not found by the game.\nRcon response: {res}"
             )
         self.rcon("demo_timescale 0.01")
-        # Wait for the demo to finish loading
-        self._wait_for_tick(10)
+        # Wait for the demo to finish loading, which doesn't necessarily write to the
+        # log so there is no timeout. Playback starting is the end of the map load,
+        # and the watchdog tells when the rest of the disk activity has settled
+        self._wait_for_tick(1, timeout=None)
+        self._wait_for_state(GameState.RUNNING, Game.load_timeout)
         self.rcon("demo_timescale 1; demo_debug 0")
 
     def quit(self):
@@ -287,107 +372,246 @@ class Game(psutil.Popen):
         """'rcon quit', mark the instance as quitted, and remove the log file"""
         self.quitted = time()
         self.rcon("quit")
+        with self._rcon_lock:
+            self._rcon_disconnect()
         self.watchdog.join()
-        os.remove(self.log_path)
+        self.remove_files()
+
+    def remove_files(self):
+        """Remove the log file and the configs generated by apply_cvars"""
+        self.log.close()
+        for path in [self.log_path, *self.generated_cfgs]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.generated_cfgs.clear()
+
+    def apply_cvars(self, cvars):
+        """
+        Apply a list of console commands with a single 'exec' of a generated config
+        file. The file ends by echoing a checksum of its contents, which has to show up
+        in the rcon response or the console log for the changes to count as applied.
+        If it doesn't, fall back to ';' joined rcon batches, each checked the same way
+        """
+        if not self.watchdog_exceptions.empty():
+            raise self.watchdog_exceptions.get()
+        cvars = [c for c in cvars if c]
+        if not cvars:
+            return
+
+        body = "\n".join(cvars) + "\n"
+        marker = f"demoknight_{zlib.crc32(body.encode()):08x}"
+        cfg = self.log_path.parent / "cfg" / f"{marker}.cfg"
+        if cfg not in self.generated_cfgs:
+            cfg.parent.mkdir(exist_ok=True)
+            with open(cfg, "w", encoding="utf-8") as f:
+                f.write(body + f"echo {marker}\n")
+            self.generated_cfgs.add(cfg)
+
+        try:
+            self.log.expect(marker)
+            if marker in self.rcon(f"exec {marker}") or self._log_has(marker):
+                logging.info(f"Applied {len(cvars)} cvars through {cfg.name}")
+                return
+
+            logging.warning(
+                f"Could not confirm {cfg.name} was executed, using rcon batches"
+            )
+            for batch in Game._batch_commands(cvars, f"echo {marker}"):
+                self.log.expect(marker)
+                if not (marker in self.rcon(batch) or self._log_has(marker)):
+                    raise RuntimeError(
+                        f"Game did not confirm cvars were applied: {batch}"
+                    )
+        finally:
+            self.log.forget(marker)
+
+    def _log_has(self, text, timeout=2):
+        """Wait up to timeout seconds for an expected text to show up in the log"""
+        deadline = time() + timeout
+        try:
+            self.log.wait(lambda: self.log.seen(text) or time() > deadline, timeout)
+        except TimeoutError:
+            return False
+        return self.log.seen(text)
 
     def gototick(self, tick: int, tick_interval):
         if not self.watchdog_exceptions.empty():
             raise self.watchdog_exceptions.get()
         """
         rcon demo_gototick and wait for the tick to be reached before returning. If the
-        game has ramped to full fastfoward speed, it may overshoot the desired tick. So
-        this actually runs demo_gototick twice. Once to approach, and the other to the
+        game has ramped to full fastfoward speed, it may overshoot the desired tick, so
+        the steps to get there are planned by a FastForward model of this demo that
+        learns from every step how far it can go and how fast without overshooting
         """
-        # Lower timescale too much and the game becomes unresponsive, lower too little
-        # and you can't start respond fast enough, and have to increase the buffer
-        # between gototicks and prevent the start of the demo from being used
+        ff = self.fastforward
+        if ff is None or ff.demo != (self.demo, tick_interval):
+            ff = self.fastforward = FastForward(self.demo, tick_interval)
+
         self.rcon("demo_debug 1")
-        end = 0
-        scale = 24
-        while scale > 0.05 and tick - end > 10:
-            end = round(end + ((tick - end) / 2))
-            scale = (tick_interval * (tick - end)) / 2
-            if scale > 12:
-                self.rcon(f"demo_gototick {end}")
-                end = self._wait_for_tick(end)
-                continue
-            else:
-                logging.warning(f"timescale: {scale} end: {end}")
-                self.rcon(f"demo_timescale {scale}")
-                end = self._wait_for_tick(end)
-        if end > tick:
-            raise TimeoutError(
-                "Log file was not updated fast enough, making the demo go past desired tick"
-            )
-        logging.warning(f"waiting for: {tick}")
-        self.rcon("demo_timescale 0.05")
-        self._wait_for_tick(tick)
+        try:
+            for command, value, wait in ff.plan(self.log.tick, tick):
+                if self.log.tick > tick:
+                    raise TimeoutError(
+                        "Log file was not updated fast enough, making the demo go"
+                        " past desired tick"
+                    )
+                logging.info(f"{command} {value}, waiting for: {wait}")
+                start = self.log.tick
+                tic = perf_counter()
+                self.rcon(f"{command} {value}")
+                reached = self._wait_for_tick(wait)
+                ff.observe(command, value, wait, start, reached, perf_counter() - tic)
+        finally:
+            ff.save()
         self.rcon("demo_debug 0; demo_timescale 1")
         return True
 
-    def _wait_for_tick(self, tick):
-        # print(steamdir)
-        curr_tick_pat = re.compile(r"[0-9]+(?= dem\_usercmd)")
-        demo_stop_pat = re.compile(r"dem\_stop")
-        with open(self.log_path) as f:
-            for _ in watch(
-                self.log_path,
-                force_polling=system().startswith("Win"),
-                poll_delay_ms=50,
-                yield_on_timeout=True,
-            ):
-                if self.last_position > os.path.getsize(self.log_path):
-                    self.last_position = 0
-                f.seek(self.last_position)
-                loglines = f.readlines()
-                self.last_position = f.tell() - 100  # a bit of overlap wont hlurt
-                for line in reversed(loglines):
-                    # Start from the last one because time only moves foward
-                    regm = curr_tick_pat.match(line.strip())
-                    if regm:
-                        currtick = int(regm.group())
-                        if currtick >= tick:
-                            return currtick
-                    if demo_stop_pat.search(line.strip()):
-                        raise RuntimeError(
-                            "Demo ended unexpectedly, probably due to log file lagging behind"
-                        )
+    def _wait_for_tick(self, tick, timeout=5):
+        self.log.wait(lambda: self.log.tick >= tick or self.log.demo_stopped, timeout)
+        if self.log.tick >= tick:
+            return self.log.tick
+        raise RuntimeError(
+            "Demo ended unexpectedly, probably due to log file lagging behind"
+        )
+
+    @staticmethod
+    def _batch_commands(commands, marker):
+        """
+        Join commands with ';' into batches that fit rcon_batch_limit, each one ending
+        with marker
+        """
+        batch = []
+        size = len(marker)
+        for command in commands:
+            if batch and size + len(command) + 2 > Game.rcon_batch_limit:
+                yield "; ".join(batch + [marker])
+                batch = []
+                size = len(marker)
+            batch.append(command)
+            size += len(command) + 2
+        if batch:
+            yield "; ".join(batch + [marker])
+
+    @staticmethod
+    def _launch_args(gameid, game_path, steam_path, l_opts, **kwargs):
+        if gameid:
+            if system().startswith("Win"):
+                try:
+                    steam_bin = steam_path / "steam.exe"
+                except TypeError as e:
+                    raise Exception("On Windows you need to specify steam_path") from e
+            elif system().startswith("Linux"):
+                steam_bin = "steam"
+
+            args = (str(steam_bin), "-applaunch", str(gameid)) + l_opts
+
+        else:
+            args = ("mangohud", game_path) + l_opts
+
+        # Check if steam is setup correctly, only start job if it is not running or
+        # if it has the correct mangohud config already
+        if gameid:
+            logging.info("Checking if steam has the right enviroment variables set")
+            steam_state = Game._steam_state(**kwargs)
+            logging.debug(f"Steam State: {steam_state.value}")
+
+            if steam_state in (SteamState.NOT_STARTED, SteamState.CONFIGURED):
+                print("Starting game")
+                print("The game must be in focus to be benchmarked properly")
+            elif steam_state == SteamState.NO_MANGOHUD:
+                raise OSError(
+                    "Steam is running but does not have the right GAME_DEBUGGER, please"
+                    " close Steam so it can be opened with the correct launch options"
+                )
+
+            # Due to a vulnerability related to using the steam protocol through a
+            # browser, steam has disabled the ability to use %command% in launch
+            # options using the 'steam' command
+
+            # So to launch the game with mangohud, it's easier if we just launch
+            # steam with GAME_DEBUGGER set. Another option would be to append the
+            # vtf file that handles launch options inside ~/.steam.
+            elif steam_state == SteamState.NOT_CONFIGURED:
+                raise OSError(
+                    "Steam is running but does not have the right MANGOHUD_CONFIG,"
+                    " please close Steam so it can be opened with the correct launch"
+                    " options"
+                )
             else:
-                raise TimeoutError("Log file took more than 5 seconds to be updated")
+                raise OSError("unknown steam_state")
+
+        return args
 
     @staticmethod
-    def _steam_state(env=(), **kwargs):
-        for proc in psutil.process_iter():
+    def _write_paths(game_path):
+        """Parse gameinfo.txt for the directories the game writes its logs to"""
+        gameinfo_path = tuple(game_path.parent.glob("./*/gameinfo.txt"))[0]
+
+        gameinfo = vdf.load(open(gameinfo_path), mapper=vdf.VDFDict)
+        write_paths = []
+        for k, v in gameinfo["GameInfo"]["FileSystem"]["SearchPaths"].iteritems():
+            if v.startswith("|all_source_engine_paths|"):
+                v = game_path.parent.absolute() / Path(
+                    v.replace("|all_source_engine_paths|", "")
+                )
+            elif v.startswith("|gameinfo_path|"):
+                v = game_path.parent.absolute() / Path(v.replace("|gameinfo_path|", ""))
+            else:
+                v = game_path.parent.absolute() / Path(v)
+            if any(
+                i in k.split("+")
+                for i in ("default_write_path", "game_write", "mod_write")
+            ):
+                if v not in write_paths:
+                    write_paths.append(Path(v))
+        return write_paths
+
+    @staticmethod
+    def _clear_log(write_paths):
+        """Find demoknight.log in the game's write paths and remove it"""
+        logs = [file for path in write_paths for file in path.glob("./demoknight.log")]
+
+        # Clear log file before each run given we are spamming it so much
+        if len(logs) > 1:
+            raise FileNotFoundError("More than one demoknight.log file was found")
+        elif logs:
+            log_path = logs[0]
             try:
-                processes = proc.name().lower()
-            except psutil.AccessDenied as e:
-                raise Exception(
-                    f"Could not check if Steam is running: Access Denied\n{e}"
-                ) from e
-            if "steam" in processes:
-                if system().startswith("Linux"):
+                logging.info(f"Removing {log_path}")
+                os.remove(log_path)
+            except FileNotFoundError:
+                logging.info(f"{log_path} doesn't exists, continuig.")
+            return log_path
+        return None
+
+    @staticmethod
+    def _steam_state(env=(), **kwargs):
+        for proc in Game.processes.named("steam"):
+            if system().startswith("Linux"):
+                try:
                     proc_env = proc.environ()
-                    # if "MANGOHUD" not in proc_env:
-                    if "GAME_DEBUGGER" not in proc_env:
-                        return SteamState.NO_MANGOHUD
-                    if "MANGOHUD_CONFIGFILE" not in proc_env:
+                except psutil.NoSuchProcess:
+                    continue
+                except psutil.AccessDenied as e:
+                    raise Exception(
+                        f"Could not check if Steam is running: Access Denied\n{e}"
+                    ) from e
+                # if "MANGOHUD" not in proc_env:
+                if "GAME_DEBUGGER" not in proc_env:
+                    return SteamState.NO_MANGOHUD
+                if "MANGOHUD_CONFIGFILE" not in proc_env:
+                    return SteamState.NOT_CONFIGURED
+                for cfg in env["MANGOHUD_CONFIGFILE"].split(","):
+                    if cfg not in proc_env["MANGOHUD_CONFIGFILE"].split(","):
                         return SteamState.NOT_CONFIGURED
-                    for cfg in env["MANGOHUD_CONFIGFILE"].split(","):
-                        if cfg not in proc_env["MANGOHUD_CONFIGFILE"].split(","):
-                            return SteamState.NOT_CONFIGURED
-                return SteamState.CONFIGURED
+            return SteamState.CONFIGURED
         return SteamState.NOT_STARTED
 
     @staticmethod
-    def _find_game_proc(game_path):
-        pid = None
-        for p in psutil.process_iter(["pid", "cmdline", "name"]):
-            if p.info["cmdline"] and p.info["cmdline"][0].startswith(
-                str(game_path.absolute())
-            ):
-                pid = p.info["pid"]
-                logging.info(f"Process found: {p.info['name']}")
-        return pid
+    def _find_game_proc(game_path, root=None):
+        return Game.processes.find(game_path, root)
 
 
 class SteamState(Enum):
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from time import time
+
+
+class Journal:
+    """
+    Append-only record of a job, one JSON object per line, flushed to disk after
+    every write. Records are:
+
+    - job: the job's arguments, written once when it starts
+    - pass: a pass of a test finished, with its capture file and pass_info
+    - set: a value of the summary, or of one of its tests, changed
+    - event: something happened, kept for the log but not in the summary
+
+    Every write costs the same however long the job has been running, and a crash
+    can at worst cut the last line short, which read() skips. read() replays the
+    records into the same summary main() has always written
+    """
+
+    def __init__(self, path, append=False):
+        self.path = Path(path)
+        if append and self.path.exists():
+            # Drop a record cut short by a crash, or the next one would be glued to it
+            with open(self.path, "rb+") as f:
+                data = f.read()
+                f.truncate(data.rfind(b"\n") + 1)
+        self.file = open(self.path, "a" if append else "w", encoding="utf-8")
+
+    def job(self, args):
+        self._write({"type": "job", "args": args})
+
+    def add_pass(self, test, result, info):
+        self._write({"type": "pass", "test": test, "result": result, "info": info})
+
+    def set(self, key, value, test=None):
+        record = {"type": "set", "key": key, "value": value}
+        if test is not None:
+            record["test"] = test
+        self._write(record)
+
+    def event(self, event, **details):
+        self._write({"type": "event", "event": event, "time": time(), **details})
+
+    def close(self):
+        self.file.close()
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    @staticmethod
+    def records(path):
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().split("\n")
+        for n, line in enumerate(lines):
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                if any(lines[n + 1 :]):
+                    raise ValueError(f"Corrupt record on line {n + 1} of {path}")
+                logging.warning(f"Skipping the unfinished last record of {path}")
+
+    @staticmethod
+    def read(path):
+        """Replay a journal into a summary"""
+        summary = None
+        tests = {}
+        for record in Journal.records(path):
+            kind = record["type"]
+            if kind == "job":
+                summary = record["args"]
+                for test in summary["tests"]:
+                    test.setdefault("results", [])
+                    test.setdefault("pass_info", [])
+                    tests[test["name"]] = test
+            elif summary is None:
+                raise ValueError(f"{path} does not start with a job record")
+            elif kind == "pass":
+                tests[record["test"]]["results"].append(record["result"])
+                tests[record["test"]]["pass_info"].append(record["info"])
+            elif kind == "set":
+                target = tests[record["test"]] if "test" in record else summary
+                target[record["key"]] = record["value"]
+        if summary is None:
+            raise ValueError(f"{path} is empty")
+        return summary
+
+    @staticmethod
+    def load(path):
+        """
+        Summary of a job from its journal or summary file. For a summary, its journal
+        is used instead if there is a newer one, since it can have passes the summary
+        doesn't
+        """
+        path = Path(path)
+        if path.suffix != ".jsonl":
+            journal = path.with_suffix(".jsonl")
+            if not journal.exists() or journal.stat().st_mtime < path.stat().st_mtime:
+                with open(path, encoding="utf-8") as f:
+                    return json.load(f)
+            path = journal
+        return Journal.read(path)
+
+    @staticmethod
+    def compact(path, output):
+        """Write the summary of a journal to output, replacing it atomically"""
+        summary = Journal.read(path)
+        output = Path(output)
+        temp = output.with_name(output.name + ".tmp")
+        with open(temp, "w", newline="", encoding="utf-8") as outfile:
+            json.dump(summary, outfile, default=str)
+        os.replace(temp, output)
+        return summary
+
+
+if __name__ == "__main__":
+    # python -m demoknight.journal <journal> [summary], to recover the summary of a
+    # job that didn't get to write it
+    journal = Path(sys.argv[1])
+    Journal.compact(
+        journal, sys.argv[2] if len(sys.argv) > 2 else journal.with_suffix(".json")
+    )
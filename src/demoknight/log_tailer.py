@@ -0,0 +1,143 @@
+import logging
+import os
+import re
+from platform import system
+
+from watchfiles import watch
+
+
+class LogTailer:
+    """
+    Follows the game's console log through a single open handle, reading only the
+    bytes written since the last poll. Only complete lines are parsed, and they are
+    scanned as bytes for the latest demo tick, for demo playback stopping and for any
+    markers a caller is expecting. The results are published as attributes for the
+    waiters
+    """
+
+    tick_pat = re.compile(rb"[ \t]*([0-9]+) dem_usercmd")
+    tick_marker = b" dem_usercmd"
+    stop_marker = b"dem_stop"
+
+    def __init__(self, path):
+        self.path = path
+        self.tick = -1
+        self.demo_stopped = False
+        self._expected = {}
+        self._file = None
+        self._inode = None
+        self._position = 0
+        self._partial = b""
+
+    def poll(self):
+        """Read and scan whatever was appended since the last poll"""
+        chunk = self._read_lines()
+        if not chunk:
+            return False
+
+        tick_at = self._scan_tick(chunk)
+        stop_at = chunk.rfind(self.stop_marker)
+        if stop_at > tick_at:
+            self.demo_stopped = True
+        elif tick_at >= 0:
+            self.demo_stopped = False
+
+        for needle in self._expected:
+            if not self._expected[needle] and needle in chunk:
+                self._expected[needle] = True
+        return True
+
+    def reset(self):
+        """Consume what is in the log so far and forget the last tick and demo stop"""
+        self.poll()
+        self.tick = -1
+        self.demo_stopped = False
+
+    def expect(self, text):
+        """Start looking for text in the lines written from now on"""
+        self._expected[text.encode()] = False
+
+    def seen(self, text):
+        return self._expected.get(text.encode(), False)
+
+    def forget(self, text):
+        self._expected.pop(text.encode(), None)
+
+    def wait(self, predicate, timeout=5):
+        """
+        Poll the log every time it changes until predicate() is true. timeout is how
+        long the log may go without being written to, None to wait forever
+        """
+        self.poll()
+        if predicate():
+            return
+        for changes in watch(
+            self.path,
+            force_polling=system().startswith("Win"),
+            poll_delay_ms=50,
+            rust_timeout=(timeout or 5) * 1000,
+            yield_on_timeout=timeout is not None,
+        ):
+            if not changes:
+                raise TimeoutError(
+                    f"Log file took more than {timeout} seconds to be updated"
+                )
+            self.poll()
+            if predicate():
+                return
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_lines(self):
+        if not self._open():
+            return b""
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self._position:
+            # The log was cleared (-conclearlog), start over
+            logging.debug(f"{self.path} shrank, reading it from the start")
+            self._position = 0
+            self._partial = b""
+        if size == self._position:
+            return b""
+
+        self._file.seek(self._position)
+        data = self._partial + self._file.read(size - self._position)
+        self._position = size
+        # Keep an unfinished last line for the next poll
+        cut = data.rfind(b"\n") + 1
+        self._partial = data[cut:]
+        return data[:cut]
+
+    def _open(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return self._file is not None
+        if self._file is None or inode != self._inode:
+            # Either the first poll, or the file was deleted and created again
+            self.close()
+            self._file = open(self.path, "rb")
+            self._inode = inode
+            self._position = 0
+            self._partial = b""
+        return True
+
+    def _scan_tick(self, chunk):
+        """
+        Only the latest tick matters, so search backwards from the end of the chunk
+        and stop at the first line that matches. Returns where that line starts
+        """
+        end = len(chunk)
+        while True:
+            found = chunk.rfind(self.tick_marker, 0, end)
+            if found < 0:
+                return -1
+            start = chunk.rfind(b"\n", 0, found) + 1
+            match = self.tick_pat.match(chunk, start, found + len(self.tick_marker))
+            if match:
+                self.tick = int(match.group(1))
+                return start
+            end = found
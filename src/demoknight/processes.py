@@ -0,0 +1,99 @@
+import logging
+from time import time
+
+import psutil
+
+
+class ProcessIndex:
+    """
+    Names, command lines and creation times of the running processes, refreshed
+    incrementally: every refresh lists the pids once and only inspects the ones that
+    weren't there before. Pids can be reused, so matches are inspected again before
+    being returned. Lookups first follow the process tree of the launcher, since that is
+    where the game shows up when it isn't started through an already running Steam
+    """
+
+    # Processes younger than this many seconds are inspected on every refresh, as
+    # one indexed between fork and exec still has the command line of its parent
+    young = 10
+
+    def __init__(self):
+        self.processes = {}
+
+    def refresh(self):
+        pids = set(psutil.pids())
+        for pid in self.processes.keys() - pids:
+            del self.processes[pid]
+        now = time()
+        for pid in pids:
+            indexed = self.processes.get(pid)
+            if indexed is None or (indexed[2] or 0) > now - ProcessIndex.young:
+                self.processes[pid] = ProcessIndex._describe(pid)
+
+    def find(self, game_path, root=None):
+        """
+        Pid of the process running game_path, searching root's tree first. Wrapper
+        scripts can match too, so the last match, the most deeply nested, wins
+        """
+        prefix = str(game_path.absolute())
+        if root is not None:
+            try:
+                launcher = psutil.Process(root)
+                tree = [launcher] + launcher.children(recursive=True)
+            except psutil.NoSuchProcess:
+                tree = []
+            found = None
+            for proc in tree:
+                name, cmdline, _ = ProcessIndex._describe(proc)
+                if cmdline and cmdline[0].startswith(prefix):
+                    found = proc.pid, name
+            if found:
+                logging.info(f"Process found in the launcher's tree: {found[1]}")
+                return found[0]
+
+        self.refresh()
+        found = None
+        for pid, (name, cmdline, _) in self.processes.items():
+            if cmdline and cmdline[0].startswith(prefix) and self._still(pid):
+                found = pid, name
+        if found:
+            logging.info(f"Process found: {found[1]}")
+            return found[0]
+        return None
+
+    def named(self, text):
+        """Processes whose name contains text, case insensitive"""
+        self.refresh()
+        text = text.lower()
+        found = []
+        for pid, (name, _, _) in self.processes.items():
+            if name and text in name.lower() and self._still(pid):
+                try:
+                    found.append(psutil.Process(pid))
+                except psutil.NoSuchProcess:
+                    pass
+        return found
+
+    def _still(self, pid):
+        """Whether pid is still the process it was indexed as"""
+        indexed = self.processes[pid]
+        current = ProcessIndex._describe(pid)
+        self.processes[pid] = current
+        return current[0] is not None and current == indexed
+
+    @staticmethod
+    def _describe(proc):
+        """Name, command line and creation time of a Process or pid"""
+        try:
+            if not isinstance(proc, psutil.Process):
+                proc = psutil.Process(proc)
+            with proc.oneshot():
+                return proc.name(), tuple(proc.cmdline()), proc.create_time()
+        except psutil.NoSuchProcess:
+            return None, (), None
+        except psutil.AccessDenied:
+            # Other users' processes, the name is usually still readable
+            try:
+                return proc.name(), (), proc.create_time()
+            except psutil.Error:
+                return None, (), None
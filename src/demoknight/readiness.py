@@ -0,0 +1,117 @@
+import logging
+import os
+from time import perf_counter, sleep
+
+import psutil
+
+from .stats import equivalent
+
+
+class ReadinessDetector:
+    """
+    Decides when a freshly launched game has finished doing whatever it does after
+    the main menu shows up (workshop downloads, shader caches, autoexec scripts...).
+
+    Every `interval` seconds it samples rcon latency, the game's CPU and disk I/O
+    rates and how fast the console log grows. The game is ready once, for every
+    signal, the last `window` samples are equivalent to the `window` before them:
+    two one-sided tests at `confidence` must place the difference of their means
+    within a margin of `relative_margin` of the older mean, or the signal's absolute
+    floor, whichever is larger.
+    """
+
+    interval = 0.1
+    window = 10
+    relative_margin = 0.1
+
+    # Smallest differences worth waiting for, in seconds, CPU seconds per second,
+    # bytes per second and bytes per second
+    floors = {
+        "rcon": 0.002,
+        "cpu": 0.05,
+        "io": 256 * 1024,
+        "log": 4 * 1024,
+    }
+
+    def __init__(self, game, confidence=0.95, timeout=120):
+        self.game = game
+        self.confidence = confidence
+        self.timeout = timeout
+        self.samples = {signal: [] for signal in self.floors}
+        self._last = None
+
+    def wait(self):
+        """
+        Sample until the game is ready, or give up after timeout seconds. Returns
+        whether it was found ready
+        """
+        start = perf_counter()
+        while perf_counter() - start < self.timeout:
+            self.sample()
+            if self.ready():
+                logging.info(
+                    f"Game ready after {perf_counter() - start:.1f}s of readiness"
+                    " checks"
+                )
+                return True
+            sleep(self.interval)
+        logging.warning(
+            f"Game did not settle down after {self.timeout} seconds, starting anyway"
+        )
+        return False
+
+    def sample(self):
+        tic = perf_counter()
+        self.game.rcon("echo Waiting for responsiveness")
+        latency = perf_counter() - tic
+
+        now = perf_counter()
+        counters = self._counters()
+        if self._last is not None:
+            then, last = self._last
+            elapsed = now - then
+            self.samples["rcon"].append(latency)
+            for signal, value in counters.items():
+                if value is None or last[signal] is None:
+                    # Not available on this platform or for this user, drop it
+                    self.samples.pop(signal, None)
+                elif signal in self.samples:
+                    self.samples[signal].append((value - last[signal]) / elapsed)
+        self._last = (now, counters)
+        logging.debug(
+            "Readiness samples: "
+            + ", ".join(f"{k}={v[-1]:.4g}" for k, v in self.samples.items() if v)
+        )
+
+    def ready(self):
+        for signal, values in self.samples.items():
+            if len(values) < 2 * self.window:
+                return False
+            old = values[-2 * self.window : -self.window]
+            new = values[-self.window :]
+            margin = max(
+                abs(sum(old) / self.window) * self.relative_margin,
+                self.floors[signal],
+            )
+            if not equivalent(old, new, margin, self.confidence):
+                return False
+        return True
+
+    def _counters(self):
+        counters = {}
+        try:
+            with self.game.oneshot():
+                times = self.game.cpu_times()
+                counters["cpu"] = times.user + times.system
+                try:
+                    io = self.game.io_counters()
+                    counters["io"] = io.read_bytes + io.write_bytes
+                except (psutil.AccessDenied, AttributeError):
+                    counters["io"] = None
+        except psutil.AccessDenied:
+            counters["cpu"] = counters["io"] = None
+        try:
+            counters["log"] = os.stat(self.game.log_path).st_size
+        except (OSError, TypeError):
+            counters["log"] = None
+        return counters
@@ -0,0 +1,215 @@
+import logging
+from random import Random
+
+import numpy as np
+
+from .session import Session
+from .stats import equivalent, t_ppf, welch
+
+
+class Scheduler:
+    """
+    Decides in which order the passes of a loop run. Passes are handed out in units,
+    a unit being what gets retried as a whole when the game crashes:
+
+    - sequential: every pass of a test, then the next test, as it always was
+    - interleaved: tests that can share a game (same launch key) take turns, one
+      pass each per round (ABAB...), and each round is a unit
+    - random: same rounds, shuffled
+
+    Tests that need a different launch are never interleaved with each other, as
+    that would mean a restart for every pass. With anchor_every, a baseline pass is
+    slipped in after every anchor_every passes of other tests that share its launch
+    key, so drift can be measured throughout the loop and not only at its start.
+
+    With target_ci, the number of passes isn't fixed: tests get one pass per unit
+    until stop_reason has a reason for them to stop. Tests given up on after crashing
+    too often get no more passes
+    """
+
+    orders = ("sequential", "interleaved", "random")
+
+    def __init__(self, args, tests):
+        self.args = args
+        self.tests = tests
+        # Keep the seed in the summary so a random order can be repeated
+        if args.seed is None:
+            args.seed = Random().randrange(2**32)
+        self.random = Random(args.seed)
+        self.failed = set()
+        self.baseline = next(
+            (t for t in tests if args.tests[t.index]["name"] == "baseline"), None
+        )
+
+        # Tests grouped by launch key, in order of first appearance
+        self.blocks = {}
+        for test in tests:
+            key = Session.launch_key(args.tests[test.index])
+            self.blocks.setdefault(key, []).append(test)
+        if args.anchor_every and self.baseline is None:
+            logging.warning("--anchor-every needs a baseline test, no anchors will run")
+        if args.order != "sequential" and not args.reuse_game:
+            logging.warning(
+                f"--order {args.order} without --reuse-game restarts the game for"
+                " every pass"
+            )
+
+    def units(self, loop=0):
+        """Yield the units of a loop, each a list of (test, anchor) passes"""
+        self.since_anchor = 0
+        for key, block in self.blocks.items():
+            if self.args.target_ci:
+                yield from self._adaptive(key, block, loop)
+                continue
+            if self.args.order == "sequential":
+                rounds = [[(test, False)] * self.args.passes for test in block]
+            else:
+                rounds = []
+                for _ in range(self.args.passes):
+                    order = list(block)
+                    if self.args.order == "random":
+                        self.random.shuffle(order)
+                    rounds.append([(test, False) for test in order])
+            for unit in rounds:
+                unit = [p for p in self._anchored(key, unit) if p[0] not in self.failed]
+                if unit:
+                    yield unit
+
+    def _adaptive(self, key, block, loop):
+        """
+        One pass per unit and test, until every test of the block has a reason to
+        stop. Sequential order finishes a test before starting the next one
+        """
+        passes = {test: 0 for test in block}
+        active = list(block)
+        while active:
+            active = [test for test in active if test not in self.failed]
+            if not active:
+                break
+            order = active[:1] if self.args.order == "sequential" else list(active)
+            if self.args.order == "random":
+                self.random.shuffle(order)
+            yield self._anchored(key, [(test, False) for test in order])
+            for test in order:
+                if test in self.failed:
+                    continue
+                passes[test] += 1
+                reason = self.stop_reason(test, passes[test], loop)
+                if reason:
+                    logging.info(f"Stopping {test.name} after {passes[test]} passes")
+                    test.stop_reason = reason
+                    active.remove(test)
+
+    def give_up(self, test):
+        """Schedule no more passes of test, anchors included"""
+        self.failed.add(test)
+        test.stop_reason = "crashed"
+
+    def _anchored(self, key, unit):
+        if not self.args.anchor_every or self.baseline is None:
+            return unit
+        if key != Session.launch_key(self.args.tests[self.baseline.index]):
+            return unit
+        anchored = []
+        for test, anchor in unit:
+            anchored.append((test, anchor))
+            if test is self.baseline:
+                self.since_anchor = 0
+                continue
+            self.since_anchor += 1
+            if self.since_anchor >= self.args.anchor_every:
+                anchored.append((self.baseline, True))
+                self.since_anchor = 0
+        return anchored
+
+    def stop_reason(self, test, passes, loop=0):
+        """
+        Why test can stop after `passes` passes in loop, or None. The mean
+        frametimes of its passes in loop are used, anchors left out:
+
+        - ci_width: the confidence interval of the mean is narrower than target_ci
+          times the mean
+        - differs_from_baseline / same_as_baseline: the difference with the
+          baseline's mean is significant, or within target_ci times the baseline's
+          mean with two one-sided tests
+        - max_passes: none of the above after max_passes
+
+        The baseline comparisons are made again after every pass, so the error rate
+        of stop_confidence is split evenly between every pass they can be made at,
+        to keep the chance of a wrong decision over the whole loop within it
+        """
+        args = self.args
+        means = Scheduler._means(test, loop)
+        n = len(means)
+        confidence = args.stop_confidence
+        if n >= max(args.min_passes, 2):
+            mean = sum(means) / n
+            sd = (sum((x - mean) ** 2 for x in means) / (n - 1)) ** 0.5
+            half = t_ppf((1 + confidence) / 2, n - 1) * sd / n**0.5
+            if half <= args.target_ci * mean:
+                return "ci_width"
+
+            if self.baseline is not None and test is not self.baseline:
+                base = Scheduler._means(self.baseline, loop)
+                if len(base) >= max(args.min_passes, 2):
+                    looks = args.max_passes - max(args.min_passes, 2) + 1
+                    alpha = (1 - confidence) / max(looks, 1)
+                    diff, se, df = welch(means, base)
+                    t = t_ppf(1 - alpha / 2, df)
+                    if abs(diff) - t * se > 0:
+                        return "differs_from_baseline"
+                    margin = args.target_ci * sum(base) / len(base)
+                    if equivalent(means, base, margin, 1 - alpha):
+                        return "same_as_baseline"
+        if passes >= args.max_passes:
+            return "max_passes"
+        return None
+
+    @staticmethod
+    def _means(test, loop):
+        return [
+            p["mean"]
+            for p in test.pass_info
+            if p.get("mean") is not None and p["loop"] == loop and not p.get("anchor")
+        ]
+
+
+def drift_report(args):
+    """
+    Fit the drift of the baseline's mean frametime over time, from its passes and
+    anchors, and adjust the mean of every test by the drift at the time of each of
+    its passes. Returns None without at least two timed baseline passes.
+
+    The drift is only known between the first and last baseline passes, so tests
+    with passes outside of that span are left out rather than extrapolated
+    """
+    baseline = next((t for t in args.tests if t["name"] == "baseline"), None)
+    if baseline is None:
+        return None
+    points = sorted(
+        (p["time"], p["mean"])
+        for p in baseline.get("pass_info", [])
+        if p.get("mean") is not None
+    )
+    if len(points) < 2:
+        return None
+    times, means = (np.array(x) for x in zip(*points))
+    reference = means.mean()
+
+    report = {}
+    for test in args.tests:
+        passes = [p for p in test.get("pass_info", []) if p.get("mean") is not None]
+        if not passes:
+            continue
+        at = np.array([p["time"] for p in passes])
+        if at.min() < times[0] or at.max() > times[-1]:
+            logging.info(f"{test['name']} ran outside of the baseline's passes")
+            continue
+        raw = np.array([p["mean"] for p in passes])
+        drift = np.interp(at, times, means) - reference
+        report[test["name"]] = {
+            "mean": float(raw.mean()),
+            "adjusted_mean": float((raw - drift).mean()),
+            "drift": float(drift.mean()),
+        }
+    return report
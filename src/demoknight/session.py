@@ -0,0 +1,287 @@
+import json
+import logging
+import re
+import shutil
+from os import environ
+from pathlib import Path
+from platform import system
+from time import sleep
+
+from psutil import NoSuchProcess, subprocess
+
+from .game import Game
+from .readiness import ReadinessDetector
+from .test import Test
+
+
+class Session:
+    """
+    One running game and the test inputs it was launched with. Tests whose launch
+    options, game path and copied paths are the same can share it: between them the
+    cvars the previous test changed are put back to the values snapshotted before it
+    changed them, and the game is only restarted when a launch-level input differs
+    or a test runs commands that can't be undone that way
+    """
+
+    cvar_pat = re.compile(r'^"([^"]+)" = "([^"]*)"', re.MULTILINE)
+
+    def __init__(self, args):
+        self.args = args
+        self.game = None
+        self.key = None
+        self.test = None
+        self.output_folder = None
+        self.paths = []
+        # Values of every cvar changed by a test in this session, from before the
+        # first test that changed it
+        self.baseline = {}
+        self.restorable = True
+
+    def open(self, test):
+        """Return a ready game for test, launching one only if needed"""
+        key = Session.launch_key(self.args.tests[test.index])
+        if self.game is not None and self.test is not test:
+            if self.args.reuse_game and key == self.key and self.restorable:
+                self._switch(test)
+            else:
+                self.close()
+        if self.game is None:
+            self._launch(test, key)
+        return self.game
+
+    def close(self):
+        """Quit the game and put the copied paths back"""
+        if self.game is None:
+            return
+        self.game.quit()
+        self.game = None
+        Session.restore_paths(self.paths)
+        self.paths = []
+        self.test = None
+        sleep(10)
+
+    def abort(self):
+        """
+        Like close, for when something went wrong: kill whatever is left of the game,
+        remove its files and recover the copied paths from their lock files
+        """
+        if self.game is not None:
+            try:
+                self.game.kill()
+            except NoSuchProcess:
+                pass
+            self.game.remove_files()
+            self.game = None
+        for path in self.paths:
+            path = Test._check_paths(path)
+        self.paths = []
+        self.test = None
+
+    def _launch(self, test, key):
+        args = self.args
+        changes = args.tests[test.index]["changes"]
+
+        all_launch_options = (
+            args.launch_options
+            + Test.required_launch_options
+            + (
+                "+rcon_password",
+                Test._rand_pass(),
+                "+alias",
+                "rcon_password",
+                "+hostport",
+                str(Test._free_port()),
+                "+alias",
+                "hostport",
+                "+net_start",
+            )
+            + tuple(i for i in changes.get("launch-options", ()) if i is not None)
+        )
+
+        kwargs = {}
+        self.output_folder = None
+
+        if system().startswith("Win"):
+            # from msdn [1]
+            NEW_PROCESS_GROUP = 0x00000200
+            DETACHED_PROCESS = 0x00000008
+            kwargs.update(creationflags=DETACHED_PROCESS | NEW_PROCESS_GROUP)
+            kwargs.update(env=environ.copy())
+
+        elif system().startswith("Linux"):
+            # MangoHud only reads its config at launch, so every test of the session
+            # logs to the folder of the first one and gets its files moved from there
+            self.output_folder = args.raw_path.absolute() / args.output_file / test.name
+            specific_mangohud_conf = (
+                f"log_duration={args.duration + args.start_buffer}",
+                f"output_folder={self.output_folder}",
+            )
+            mangohud_conf = "\n".join(
+                Test.required_mangohud_conf + specific_mangohud_conf
+            )
+            temp_conf_dir = test.temp_dir / "MangoHud.conf"
+            with open(temp_conf_dir, "w") as conf_file:
+                conf_file.write(mangohud_conf)
+            kwargs.update(start_new_session=True)
+
+            specific_environ = Test.game_environ.copy()
+            # specific_environ.update({"MANGOHUD_CONFIG": mangohud_conf})
+            specific_environ.update({"MANGOHUD_CONFIGFILE": str(temp_conf_dir)})
+            kwargs.update(env=specific_environ)
+        else:
+            raise NotImplementedError(
+                "Unsupported OS, this tool is only available for Windows and Linux"
+            )
+
+        self.paths = list(args.tests[test.index].get("changes", {}).get("paths", []))
+        Session.apply_paths(self.paths)
+
+        # Start game and wait for it to finish loading
+        self.game = Game(
+            gameid=args.gameid,
+            game_path=args.tests[test.index].get("game-path") or args.game_path,
+            steam_path=args.steam_path,
+            l_opts=all_launch_options,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            **kwargs,
+        )
+        self.key = key
+        self.baseline = {}
+        self.restorable = True
+
+        # Due to all of the crazy shit people make run when the game starts, wait
+        # for it to settle down before doing anything
+        ReadinessDetector(self.game, args.ready_confidence).wait()
+        self._snapshot(test)
+        self.test = test
+
+    def _switch(self, test):
+        """Undo the cvars of the previous test and get ready for the next one"""
+        logging.info(f"Reusing the game of {self.test.name} for {test.name}")
+        self.game.apply_cvars(
+            [f'{name} "{value}"' for name, value in self.baseline.items()]
+        )
+        self._snapshot(test)
+        self.test = test
+
+    def _snapshot(self, test):
+        """
+        Query the current value of every cvar the test is going to change. Commands
+        that aren't cvars can't be snapshotted, so the game won't be reused after them
+        """
+        for name in Session.cvar_names(self.args.tests[test.index]):
+            if name in self.baseline:
+                continue
+            found = dict(Session.cvar_pat.findall(self.game.rcon(name)))
+            if name in found:
+                self.baseline[name] = found[name]
+            else:
+                logging.info(
+                    f"{name} is not a cvar, the game will be restarted after"
+                    f" {test.name}"
+                )
+                self.restorable = False
+
+    @staticmethod
+    def launch_key(test):
+        """Everything about a test that can only be applied by launching the game"""
+        changes = test.get("changes", {})
+        return json.dumps(
+            [
+                str(test.get("game-path") or ""),
+                [i for i in changes.get("launch-options", ()) if i is not None],
+                [[str(p["from"]), str(p["to"])] for p in changes.get("paths", [])],
+            ]
+        )
+
+    @staticmethod
+    def cvar_names(test):
+        names = []
+        for cvar in test.get("changes", {}).get("cvars", []) or []:
+            for command in (cvar or "").split(";"):
+                command = command.strip().lstrip("+")
+                if command:
+                    names.append(command.split(None, 1)[0])
+        return names
+
+    @staticmethod
+    def apply_paths(paths):
+        """Copy paths for a test, backing up whatever was already there"""
+        for path in paths:
+            source_path = Path(path["from"])
+            destination_path = Path(path["to"])
+
+            if source_path.is_dir():
+                # Copy directory tree
+                if destination_path.exists():
+                    if not destination_path.is_dir():
+                        raise ValueError(
+                            "Paths in tests must contain either 2 directory paths, or 2 file paths, separated by space"
+                        )
+                    # If the destination directory already exists, create a backup by renaming it
+                    backup_destination = destination_path.with_name(
+                        destination_path.name + ".bak"
+                    )
+                    shutil.move(destination_path, backup_destination)
+                    logging.info(f"Copied existing directory to: {backup_destination}")
+
+                # Copy the source directory to the destination
+                shutil.copytree(source_path, destination_path)
+                logging.info(
+                    f"Moved folder/file from {source_path} to {destination_path}"
+                )
+            else:
+                # Copy file
+                if destination_path.exists():
+                    # If the destination file already exists, create a backup by renaming it
+                    backup_destination = destination_path.with_name(
+                        destination_path.name + ".bak"
+                    )
+                    destination_path.rename(backup_destination)
+                    logging.info(f"Copied existing file to: {backup_destination}")
+
+                # Copy the source file to the destination
+                shutil.copy(source_path, destination_path)
+                logging.info(
+                    f"Moved folder/file from {source_path} to {destination_path}"
+                )
+
+            with open(destination_path.parent / "demoknight.lock", "a") as lock_file:
+                lock_file.write(str(destination_path) + "\n")
+
+    @staticmethod
+    def restore_paths(paths):
+        """Put back the backups made by apply_paths, or delete the copies"""
+        for path in paths:
+            destination_path = Path(path["to"])
+
+            # Check if a backup exists
+            backup_destination = destination_path.with_name(
+                destination_path.name + ".bak"
+            )
+            if backup_destination.exists():
+                # Restore the backup
+                backup_destination.rename(destination_path)
+                logging.info(f"Reverted changes. Restored backup: {destination_path}")
+
+            else:
+                # Delete the newly copied file or directory
+                if destination_path.exists():
+                    if destination_path.is_dir():
+                        shutil.rmtree(path["to"])
+                        logging.info(
+                            f"Reverted changes. Deleted directory: {destination_path}"
+                        )
+                    else:
+                        destination_path.unlink()
+                        logging.info(
+                            f"Reverted changes. Deleted file: {destination_path}"
+                        )
+            lock_file = destination_path.parent / "demoknight.lock"
+            # Several paths can share a directory, and with it a lock file
+            try:
+                lock_file.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,111 @@
+import math
+
+
+def norm_ppf(p):
+    """Quantile of the standard normal distribution, by bisection of its cdf"""
+    if not 0 < p < 1:
+        raise ValueError(f"Probability must be between 0 and 1, got {p}")
+    low, high = -40.0, 40.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if 0.5 * math.erfc(-mid / math.sqrt(2)) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def _betacf(a, b, x):
+    """Continued fraction of the incomplete beta function, by Lentz's method"""
+    tiny = 1e-300
+    c, d = 1.0, 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        for numerator in (
+            m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+            -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)),
+        ):
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1) < 1e-15:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b)"""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = math.exp(
+        math.lgamma(a + b)
+        - math.lgamma(a)
+        - math.lgamma(b)
+        + a * math.log(x)
+        + b * math.log1p(-x)
+    )
+    if x < (a + 1) / (a + b + 2):
+        return front * _betacf(a, b, x) / a
+    return 1 - front * _betacf(b, a, 1 - x) / b
+
+
+def t_cdf(t, df):
+    """Cumulative distribution function of Student's t distribution"""
+    tail = 0.5 * betainc(df / 2, 0.5, df / (df + t * t))
+    return 1 - tail if t > 0 else tail
+
+
+def t_ppf(p, df):
+    """
+    Quantile of Student's t distribution, by bisection of its cdf. Exact for any
+    degrees of freedom, fractional ones from Welch's test included, where
+    expansions from the normal distribution fall apart below 5 or so
+    """
+    if not 0 < p < 1:
+        raise ValueError(f"Probability must be between 0 and 1, got {p}")
+    if math.isinf(df):
+        return norm_ppf(p)
+    if df <= 0:
+        raise ValueError(f"Degrees of freedom must be positive, got {df}")
+    if p < 0.5:
+        return -t_ppf(1 - p, df)
+    low, high = 0.0, 1.0
+    while t_cdf(high, df) < p:
+        low, high = high, high * 2
+    for _ in range(100):
+        mid = (low + high) / 2
+        if t_cdf(mid, df) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def welch(a, b):
+    """
+    Difference between the means of two samples, its standard error and the
+    Welch-Satterthwaite degrees of freedom
+    """
+    na, nb = len(a), len(b)
+    ma, mb = sum(a) / na, sum(b) / nb
+    va = sum((x - ma) ** 2 for x in a) / (na - 1) / na
+    vb = sum((x - mb) ** 2 for x in b) / (nb - 1) / nb
+    se = math.sqrt(va + vb)
+    if se == 0:
+        return ma - mb, 0.0, math.inf
+    df = (va + vb) ** 2 / (va**2 / (na - 1) + vb**2 / (nb - 1))
+    return ma - mb, se, df
+
+
+def equivalent(a, b, margin, confidence):
+    """
+    Two one-sided tests: whether the means of a and b are within margin of each other
+    with the given confidence
+    """
+    diff, se, df = welch(a, b)
+    return abs(diff) + t_ppf(confidence, df) * se < margin
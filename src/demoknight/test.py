@@ -9,18 +9,17 @@ from argparse import Namespace
 from datetime import datetime
 from os import environ, rename, path
 from platform import system
-from time import perf_counter, sleep
+from time import sleep, time
 from tempfile import gettempdir
 from pathlib import Path
 
-import numpy as np
-from psutil import Popen, subprocess
+from psutil import Popen
 
 # TODO: Undo monkey patch when pull request is merged: https://github.com/ValvePython/vdf/pull/53
 from . import vdf_patch
 import vdf
 
-from .game import Game
+from . import frametimes
 
 if system().startswith("Linux"):
     import control
@@ -71,163 +70,45 @@ class Test:
     # game_environ.update({"MANGOHUD": "1"})
     game_environ.update({"GAME_DEBUGGER": "mangohud"})
 
+    # Broken captures of a pass in a row before it counts as failed
+    max_broken = 3
+
     def __init__(self, args, index):
         self.name = args.tests[index]["name"]
         self.results = []
+        # When, in which loop and how each result was captured, and its mean
+        self.pass_info = []
+        # Why the last loop of this test stopped adding passes, see Scheduler
+        self.stop_reason = None
         self.index = index
         self.temp_dir = Path(gettempdir()) / "demoknight"
         self.temp_dir.mkdir(parents=True, exist_ok=True)
-        self.curr_pass = 0
-
-    def capture(self, args):
-        self.curr_pass = 0
-        # create independent process just to make sure
-        # https://stackoverflow.com/questions/13243807/popen-waiting-for-child-process-even-when-the-immediate-child-has-terminated/13256908#13256908
-
-        test_launch_options = args.tests[self.index]["changes"].get(
-            "launch-options", ()
-        )
-
-        all_launch_options = (
-            args.launch_options
-            + Test.required_launch_options
-            + (
-                "+rcon_password",
-                Test._rand_pass(),
-                "+alias",
-                "rcon_password",
-                "+hostport",
-                str(Test._free_port()),
-                "+alias",
-                "hostport",
-                "+net_start",
-            )
-            + tuple(i for i in test_launch_options if i is not None)
-        )
 
-        kwargs = {}
-
-        if system().startswith("Win"):
-            # from msdn [1]
-            NEW_PROCESS_GROUP = 0x00000200
-            DETACHED_PROCESS = 0x00000008
-            kwargs.update(creationflags=DETACHED_PROCESS | NEW_PROCESS_GROUP)
-            kwargs.update(env=environ.copy())
-
-        elif system().startswith("Linux"):
-            specific_mangohud_conf = (
-                f"log_duration={args.duration + args.start_buffer}",
-                (
-                    "output_folder"
-                    f"={args.raw_path.absolute() / args.output_file / self.name}"
-                ),
-            )
-            mangohud_conf = "\n".join(
-                Test.required_mangohud_conf + specific_mangohud_conf
-            )
-            temp_conf_dir = self.temp_dir / "MangoHud.conf"
-            with open(temp_conf_dir, "w") as conf_file:
-                conf_file.write(mangohud_conf)
-            kwargs.update(start_new_session=True)
-
-            specific_environ = Test.game_environ.copy()
-            # specific_environ.update({"MANGOHUD_CONFIG": mangohud_conf})
-            specific_environ.update({"MANGOHUD_CONFIGFILE": str(temp_conf_dir)})
-            kwargs.update(env=specific_environ)
-        else:
-            raise NotImplementedError(
-                "Unsupported OS, this tool is only available for Windows and Linux"
+    def run_pass(self, args, session, loop=0, anchor=False):
+        """
+        Capture one pass and add its file to results. The capture is followed as it
+        is written, and captured again if it turns out to be broken, up to
+        max_broken times before giving up with RuntimeError
+        """
+        gm = session.open(self)
+
+        # Apply cvars for each test
+        gm.apply_cvars(args.tests[self.index]["changes"].get("cvars", []))
+
+        if args.start_tick - args.start_buffer * (1 / args.tick_interval) < 15:
+            raise Exception(
+                "Due to constraints with frametime capture and demos, minimum"
+                f" value for -s/--start-tick is {15 + args.start_buffer}"
             )
 
-        test_launch_options = args.tests[self.index]["changes"].get(
-            "launch-options", ()
-        )
-        # Move files for this test and back up if it already exists
-        for path in args.tests[self.index].get("changes", {}).get("paths", {}):
-            source_path = Path(path["from"])
-            destination_path = Path(path["to"])
-
-            if source_path.is_dir():
-                # Copy directory tree
-                if destination_path.exists():
-                    if not destination_path.is_dir():
-                        raise ValueError(
-                            "Paths in tests must contain either 2 directory paths, or 2 file paths, separated by space"
-                        )
-                    # If the destination directory already exists, create a backup by renaming it
-                    backup_destination = destination_path.with_name(
-                        destination_path.name + ".bak"
-                    )
-                    shutil.move(destination, backup_destination)
-                    logging.info(f"Copied existing directory to: {backup_destination}")
-
-                # Copy the source directory to the destination
-                shutil.copytree(source_path, destination_path)
-                logging.info(
-                    f"Moved folder/file from {source_path} to {destination_path}"
-                )
-            else:
-                # Copy file
-                if destination_path.exists():
-                    # If the destination file already exists, create a backup by renaming it
-                    backup_destination = destination_path.with_name(
-                        destination_path.name + ".bak"
-                    )
-                    destination_path.rename(backup_destination)
-                    logging.info(f"Copied existing file to: {backup_destination}")
-
-                # Copy the source file to the destination
-                shutil.copy(source_path, destination_path)
-                logging.info(
-                    f"Moved folder/file from {source_path} to {destination_path}"
-                )
-
-            with open(destination_path.parent / "demoknight.lock", "a") as lock_file:
-                lock_file.write(str(destination_path) + "\n")
-
-        # Start game and wait for it to finish loading
-        gm = Game(
-            gameid=args.gameid,
-            game_path=args.tests[self.index].get("game-path") or args.game_path,
-            steam_path=args.steam_path,
-            l_opts=all_launch_options,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            **kwargs,
-        )
-
-        # Due to all of the crazy shit people make run when the game starts,
-        # can't think of a better way to detect if they have finished running
-        # than this
-        # TODO: Include this in Game.update_state() instead
-        tictoc = []
-        for _ in range(200):
-            tic = perf_counter()
-            gm.rcon("echo Waiting for responsiveness")
-            toc = perf_counter()
-            diff = toc - tic
-            logging.debug(f"Rcon response delay: {diff}")
-            sleep(0.1)
-            tictoc.append(diff)
-            mean = np.mean(tictoc[-50:])
-            if len(tictoc) > 50 and abs(mean - diff < diff * 0.01):
-                break
-
-        for i in range(args.passes):
-            # Apply cvars for each test
-            for ch in args.tests[self.index]["changes"].get("cvars", []):
-                gm.rcon(ch)
-
+        p = args.raw_path.absolute() / args.output_file / self.name
+        # MangoHud keeps logging to the folder of the test that launched the game
+        folder = session.output_folder or p
+        broken_captures = 0
+        while True:
             # Play demo and wait for game to load
             gm.playdemo(args.demo_path)
 
-            if args.start_tick - args.start_buffer * (1 / args.tick_interval) < 15:
-                raise Exception(
-                    "Due to constraints with frametime capture and demos, minimum"
-                    f" value for -s/--start-tick is {15 + args.start_buffer}"
-                )
-
             # Go to tick and wait for fast-foward to finish
             while True:
                 try:
@@ -249,85 +130,105 @@ class Test:
                     gm.rcon("disconnect")
                     gm.playdemo(args.demo_path)
                     continue
-            gm.not_capturing.clear()
-            if system().startswith("Win"):
-                specific_presentmon_conf = (
-                    "-timed",
-                    str(args.duration + args.start_buffer),
-                    "-process_id",
-                    str(gm.pid),
-                    "-output_file",
-                    str(
-                        args.raw_path.absolute()
-                        / args.output_file
-                        / self.name
-                        / f"PresentMon-{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-                    ),
-                )
-                Popen(
-                    (args.presentmon_path,)
-                    + specific_presentmon_conf
-                    + Test.required_presentmon_conf
-                )
+            existing = set(folder.glob("./*[0-9].csv"))
+            tailer = frametimes.CaptureTailer(
+                folder, existing, args.start_buffer, args.max_frametime
+            )
+            tailer.start()
+            try:
+                gm.not_capturing.clear()
+                started = time()
+                if system().startswith("Win"):
+                    specific_presentmon_conf = (
+                        "-timed",
+                        str(args.duration + args.start_buffer),
+                        "-process_id",
+                        str(gm.pid),
+                        "-output_file",
+                        str(
+                            p
+                            / f"PresentMon-{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
+                        ),
+                    )
+                    Popen(
+                        (args.presentmon_path,)
+                        + specific_presentmon_conf
+                        + Test.required_presentmon_conf
+                    )
 
-            if system().startswith("Linux"):
-                control.control(
-                    Namespace(cmd="start-logging", socket="mangohud", info="")
-                )
+                if system().startswith("Linux"):
+                    control.control(
+                        Namespace(cmd="start-logging", socket="mangohud", info="")
+                    )
 
-            # Extend duration due to mangohud bug
-            sleep(args.duration + args.start_buffer)
-            gm.not_capturing.set()
-            sleep(0.5)
-
-            # Player animations seem to glitch out if I don't disconnect
-            # before doing "playdemo"
-            gm.rcon("disconnect")
-            sleep(0.5)
-
-            p = args.raw_path.absolute() / args.output_file / self.name
-            logs = list(p.glob("./*[0-9].csv"))
-            logs.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-            if logs[0] not in self.results:
-                self.results.append(logs[0])
-                self.curr_pass += 1
-            else:
-                gm.quit()
+                # Extend duration due to mangohud bug. Cut short if the capture breaks
+                broken = tailer.broken.wait(args.duration + args.start_buffer)
+                if broken and system().startswith("Linux"):
+                    control.control(
+                        Namespace(cmd="stop-logging", socket="mangohud", info="")
+                    )
+                elif broken:
+                    # PresentMon can't be stopped early, let it finish its file
+                    sleep(max(started + args.duration + args.start_buffer - time(), 0))
+                gm.not_capturing.set()
+                sleep(0.5)
+
+                # Player animations seem to glitch out if I don't disconnect
+                # before doing "playdemo"
+                gm.rcon("disconnect")
+                sleep(0.5)
+            finally:
+                stats = tailer.stop()
+            logs = [log for log in folder.glob("./*[0-9].csv") if log not in existing]
+            if not logs:
                 raise FileNotFoundError(
-                    "Mangohud did not generate a new file after the pass was done. Closing the game and retrying the entire test."
+                    "Mangohud did not generate a new file after the pass was done. Closing the game and retrying the pass."
                 )
-            print(f"Finished pass {i}")
-
-        gm.quit()
-        for path in args.tests[self.index].get("changes", {}).get("paths", {}):
-            destination_path = Path(path["to"])
-
-            # Check if a backup exists
-            backup_destination = destination_path.with_name(
-                destination_path.name + ".bak"
+            result = max(logs, key=lambda x: x.stat().st_mtime)
+            if broken:
+                result.unlink()
+                broken_captures += 1
+                if broken_captures >= Test.max_broken:
+                    raise RuntimeError(
+                        f"Pass of {self.name} broken {broken_captures} times in a row"
+                        f" ({tailer.reason}), see --max-frametime"
+                    )
+                logging.warning(
+                    f"Pass of {self.name} broken ({tailer.reason}), capturing it again"
+                )
+                continue
+            break
+
+        if folder != p:
+            rename(result, p / result.name)
+            result = p / result.name
+        logging.info(
+            f"{self.name}: "
+            + ", ".join(
+                f"{k} {v:.3f}" if isinstance(v, float) else f"{k} {v}"
+                for k, v in stats.items()
             )
-            if backup_destination.exists():
-                # Restore the backup
-                backup_destination.rename(destination_path)
-                logging.info(f"Reverted changes. Restored backup: {destination_path}")
-
-            else:
-                # Delete the newly copied file or directory
-                if destination_path.exists():
-                    if destination_path.is_dir():
-                        shutil.rmtree(path["to"])
-                        logging.info(
-                            f"Reverted changes. Deleted directory: {destination_path}"
-                        )
-                    else:
-                        destination_path.unlink()
-                        logging.info(
-                            f"Reverted changes. Deleted file: {destination_path}"
-                        )
-            lock_file = destination_path.parent / "demoknight.lock"
-            lock_file.unlink()
-
-        sleep(10)
+        )
+        # Binary copy of the columns analysis needs, so it never parses text again
+        frametimes.write_columns(result)
+        frametimes.record_pass(
+            p.parent / "manifest.json",
+            self.name,
+            loop,
+            sum(1 for i in self.pass_info if i["loop"] == loop),
+            result,
+        )
+        self.results.append(result)
+        self.pass_info.append(
+            {
+                "loop": loop,
+                "time": started,
+                "anchor": anchor,
+                "mean": stats.get("mean"),
+                "stats": stats,
+            }
+        )
+        return result
 
     @staticmethod
     def _check_paths(path):
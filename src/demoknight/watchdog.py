@@ -0,0 +1,170 @@
+import logging
+import os
+import select
+import socket
+import threading
+
+import psutil
+
+
+class ExitWatcher:
+    """
+    Sleeps until a process exits, a timeout runs out or someone calls wake(),
+    without polling the process at all.
+
+    Exit is noticed through a pidfd where the kernel and Python support them, and
+    otherwise by a helper thread blocked in psutil's wait(), which on Windows waits on
+    the process handle. Either way the sleeper is a single select() call that also
+    listens to a socket pair, so other threads can interrupt it.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.exited = threading.Event()
+        # Sockets and not a pipe, Windows can only select() sockets
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                self._pidfd = os.pidfd_open(pid)
+            except OSError as e:
+                logging.debug(f"pidfd_open failed ({e!r}), waiting on a thread instead")
+        if self._pidfd is None:
+            threading.Thread(target=self._wait_thread, daemon=True).start()
+
+    def wait(self, timeout=None):
+        """
+        Block for up to timeout seconds, None for no limit. Returns whether the
+        process has exited
+        """
+        if self.exited.is_set():
+            return True
+        fds = [self._wake_r] + ([self._pidfd] if self._pidfd is not None else [])
+        ready, _, _ = select.select(fds, [], [], timeout)
+        if self._wake_r in ready:
+            try:
+                while self._wake_r.recv(64):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+        if self._pidfd is not None and self._pidfd in ready:
+            self.exited.set()
+        return self.exited.is_set()
+
+    def wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            # Already a wake up pending, or closed
+            pass
+
+    def close(self):
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _wait_thread(self):
+        try:
+            psutil.Process(self.pid).wait()
+        except psutil.NoSuchProcess:
+            pass
+        self.exited.set()
+        self.wake()
+
+
+class WakingEvent(threading.Event):
+    """threading.Event that also wakes an ExitWatcher up when it is set"""
+
+    def __init__(self):
+        super().__init__()
+        self.watcher = None
+
+    def set(self):
+        super().set()
+        if self.watcher is not None:
+            self.watcher.wake()
+
+
+class LoadDetector:
+    """
+    Tells loading from running by how hard the game hits the disk and the page
+    cache. Rates are measured between consecutive samples of the bytes read, major
+    page faults and CPU time of the process. Loading starts when reads or faults
+    go over the `enter` thresholds, and ends once both have stayed under the lower
+    `leave` ones for `settle` seconds while the game keeps using some CPU.
+
+    Outside of Linux only reads are used: page fault counts there include soft
+    faults, which a running game racks up all the time
+    """
+
+    enter = {"read": 32 * 1024 * 1024, "faults": 100}
+    leave = {"read": 4 * 1024 * 1024, "faults": 10}
+    settle = 1
+    min_cpu = 0.05
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.loading = True
+        self.rates = {}
+        self._last = None
+        self._quiet_since = None
+        self._clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else None
+
+    def update(self, now):
+        """Take a sample and return whether the game is loading"""
+        counters = self._counters()
+        if self._last is not None:
+            then, last = self._last
+            elapsed = now - then
+            if elapsed > 0:
+                self.rates = {k: (counters[k] - last[k]) / elapsed for k in counters}
+        self._last = (now, counters)
+        if not self.rates:
+            return self.loading
+
+        if (
+            self.rates["read"] > self.enter["read"]
+            or self.rates["faults"] > self.enter["faults"]
+        ):
+            self.loading = True
+            self._quiet_since = None
+        elif (
+            self.rates["read"] < self.leave["read"]
+            and self.rates["faults"] < self.leave["faults"]
+            and self.rates["cpu"] > self.min_cpu
+        ):
+            self._quiet_since = self._quiet_since or then
+            if now - self._quiet_since >= self.settle:
+                self.loading = False
+        else:
+            self._quiet_since = None
+        return self.loading
+
+    def _counters(self):
+        if self._clock_ticks and os.path.isdir("/proc/self"):
+            # Straight from procfs, two reads per sample
+            try:
+                with open(f"/proc/{self.pid}/stat", "rb") as f:
+                    stat = f.read().rsplit(b")", 1)[1].split()
+                with open(f"/proc/{self.pid}/io", "rb") as f:
+                    io = dict(line.split(b": ") for line in f.read().splitlines())
+            except (FileNotFoundError, ProcessLookupError) as e:
+                raise psutil.NoSuchProcess(self.pid) from e
+            return {
+                # rchar counts reads served from the page cache too
+                "read": int(io[b"rchar"]),
+                "faults": int(stat[9]),
+                "cpu": (int(stat[11]) + int(stat[12])) / self._clock_ticks,
+            }
+        proc = psutil.Process(self.pid)
+        with proc.oneshot():
+            times = proc.cpu_times()
+            return {
+                "read": proc.io_counters().read_bytes,
+                "faults": 0,
+                "cpu": times.user + times.system,
+            }
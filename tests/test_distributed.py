@@ -0,0 +1,103 @@
+import json
+import socket
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from demoknight.analysis import kept_passes
+from demoknight.distributed import Agent, Coordinator
+
+# Stands in for demoknight: runs a job file by writing a summary and one MangoHud
+# capture per test, or fails when the job asks for it
+FAKE_JOB = """
+import json, sys
+from pathlib import Path
+
+job = json.load(open(sys.argv[sys.argv.index("--job-file") + 1]))
+if job.get("fail"):
+    sys.exit(1)
+raw = Path(job["raw-path"])
+tests = []
+for test in [{"name": "baseline"}] + job["tests"]:
+    capture = raw / test["name"] / "capture.csv"
+    capture.parent.mkdir(parents=True, exist_ok=True)
+    rows = [",".join(["0", "16.6"] + ["0"] * 11 + [str(i * 10**9)]) for i in range(5)]
+    capture.write_text("\\n".join(["os", "info", "header"] + rows) + "\\n")
+    tests.append(
+        {"name": test["name"], "results": [str(capture)], "pass_info": [{"pass": 0}]}
+    )
+with open(job["output-file"] + ".json", "w") as f:
+    json.dump({"system": None, "tests": tests}, f)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_job(tmp_path, monkeypatch, job, **kwargs):
+    monkeypatch.setattr(Agent, "poll_interval", 0.1)
+    fake = tmp_path / "fake_job.py"
+    fake.write_text(FAKE_JOB)
+    coord = Coordinator(job, tmp_path / "merged", tmp_path / "raw", **kwargs)
+    port = free_port()
+    server = threading.Thread(target=coord.serve, args=("127.0.0.1", port))
+    server.start()
+    agents = [
+        threading.Thread(
+            target=Agent(
+                f"http://127.0.0.1:{port}",
+                f"rig{i}",
+                tmp_path / f"agent{i}",
+                [sys.executable, str(fake)],
+                kwargs.get("token"),
+            ).run
+        )
+        for i in range(2)
+    ]
+    for a in agents:
+        a.start()
+    for t in agents + [server]:
+        t.join(60)
+        assert not t.is_alive()
+    with open(tmp_path / "merged.json", encoding="utf-8") as f:
+        return coord, json.load(f)
+
+
+def test_two_agents_merge(tmp_path, monkeypatch):
+    job = {"loops": 2, "tests": [{"name": "a"}, {"name": "b"}]}
+    coord, merged = run_job(tmp_path, monkeypatch, job, tests_per_item=1, token="s")
+
+    assert merged["loops"] == 2
+    assert merged["failed_items"] == {}
+    tests = {t["name"]: t for t in merged["tests"]}
+    assert set(tests) == {"baseline", "a", "b"}
+    # Every item has its own baseline pass
+    assert len(tests["baseline"]["results"]) == 4
+    for name in ("a", "b"):
+        assert sorted(i["loop"] for i in tests[name]["pass_info"]) == [0, 1]
+    for test in tests.values():
+        for result, info in zip(test["results"], test["pass_info"]):
+            assert info["rig"] in merged["rigs"]
+            assert Path(result).exists()
+    # The warm-up passes of every item are discarded, not only the first of a loop
+    assert kept_passes({"passes": 1, "discard_passes": 1}, tests["baseline"]) == []
+
+
+def test_failing_item_given_up(tmp_path, monkeypatch):
+    job = {"loops": 1, "fail": True, "tests": [{"name": "a"}]}
+    coord, merged = run_job(tmp_path, monkeypatch, job, attempts=2)
+
+    assert coord.handed_out[0] == 2
+    assert list(merged["failed_items"]) == ["0"]
+
+
+def test_capture_outside_raw_path(tmp_path):
+    coord = Coordinator({"tests": [{"name": "a"}]}, tmp_path / "m", tmp_path / "raw")
+    for test, name in (("../..", "x.csv"), ("c", "x.csv"), ("a", "..")):
+        with pytest.raises(ValueError):
+            coord.capture(0, test, name, b"")